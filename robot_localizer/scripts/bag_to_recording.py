@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+""" Converts a bag file recorded on the robot into the npz recording format
+    of replay.py, so that real captures can be replayed without a ROS master.
+
+    usage: bag_to_recording.py ../bags/ac109_1.bag ac109_1.npz
+
+    The odometry comes from the nav_msgs/Odometry messages on --odom-topic.
+    The scans come from --scan-topic, which may carry either
+        sensor_msgs/PointCloud: e.g. the neato's projected_stable_scan.
+            Clouds in the odom frame are moved into the base frame with the
+            odometry interpolated to their stamp
+        sensor_msgs/LaserScan: the ranges are converted to points in the
+            laser frame and moved into the base frame with the laser's pose
+    Clouds or scans in any frame other than odom and base_link need a
+    transform from the base frame to that frame, taken from the first one
+    published directly between the two on /tf or /tf_static in the bag, or
+    given with --sensor-pose.
+
+    Only the rosbag Python package is needed (no ROS master); it is imported
+    when the script runs. """
+
+import argparse
+import sys
+
+import numpy as np
+
+from replay import Recording, save_recording
+from se2 import SE2
+
+
+def yaw_from_quaternion(q):
+    """ The rotation about z of a geometry_msgs/Quaternion """
+    return np.arctan2(2.0*(q.w*q.z + q.x*q.y), 1.0 - 2.0*(q.y*q.y + q.z*q.z))
+
+
+def laser_scan_points(msg):
+    """ Returns the valid returns of a sensor_msgs/LaserScan as an N x 2 array
+        of (x, y) coordinates in the laser frame """
+    ranges = np.asarray(msg.ranges, dtype=np.float64)
+    angles = msg.angle_min + np.arange(len(ranges))*msg.angle_increment
+    valid = np.isfinite(ranges) & (ranges > msg.range_min) & \
+        (ranges < msg.range_max)
+    return np.column_stack((ranges[valid]*np.cos(angles[valid]),
+                            ranges[valid]*np.sin(angles[valid])))
+
+
+def point_cloud_points(msg):
+    """ Returns the points of a sensor_msgs/PointCloud as an N x 2 array """
+    points = np.empty((len(msg.points), 2))
+    points[:, 0] = [point.x for point in msg.points]
+    points[:, 1] = [point.y for point in msg.points]
+    return points
+
+
+def read_bag(path, odom_topic="/odom", scan_topic="/projected_stable_scan",
+             base_frame="base_link", odom_frame="odom", sensor_pose=None,
+             initial_pose=None):
+    """ Reads the odometry and scans of a bag into a Recording.  sensor_pose
+        is the (x, y, theta) pose of the scan frame in the base frame if it is
+        not in the bag's tf messages.  Scans outside of the recorded odometry,
+        or in a frame whose pose is unknown, are dropped. """
+    import rosbag
+
+    odom_stamps, odom = [], []
+    scans = []
+    sensor_poses = {}
+    with rosbag.Bag(path) as bag:
+        for topic, msg, _ in bag.read_messages(
+                topics=[odom_topic, scan_topic, "/tf", "/tf_static"]):
+            if topic == odom_topic:
+                pose = msg.pose.pose
+                odom_stamps.append(msg.header.stamp.to_sec())
+                odom.append((pose.position.x, pose.position.y,
+                             yaw_from_quaternion(pose.orientation)))
+            elif topic == scan_topic:
+                if msg._type == "sensor_msgs/LaserScan":
+                    points = laser_scan_points(msg)
+                else:
+                    points = point_cloud_points(msg)
+                scans.append((msg.header.stamp.to_sec(),
+                              msg.header.frame_id.lstrip("/"), points))
+            else:
+                for transform in msg.transforms:
+                    parent = transform.header.frame_id.lstrip("/")
+                    child = transform.child_frame_id.lstrip("/")
+                    if parent == base_frame and child not in sensor_poses:
+                        t = transform.transform
+                        sensor_poses[child] = SE2(
+                            t.translation.x, t.translation.y,
+                            yaw_from_quaternion(t.rotation))
+
+    if not(odom):
+        raise ValueError("no odometry on %s in %s" % (odom_topic, path))
+    # the bag may interleave the topics slightly out of order
+    order = np.argsort(odom_stamps, kind="stable")
+    odom_stamps = np.asarray(odom_stamps)[order]
+    odom = np.asarray(odom)[order]
+    odometry = Recording(odom_stamps, odom, [], [0], np.zeros((0, 2)))
+
+    scan_stamps, scan_points = [], []
+    for stamp, frame, points in sorted(scans, key=lambda scan: scan[0]):
+        if not(odom_stamps[0] <= stamp <= odom_stamps[-1]):
+            continue
+        if frame == odom_frame:
+            to_base = SE2.from_xy_theta(odometry.odom_at(stamp)).inverse()
+        elif frame == base_frame:
+            to_base = SE2()
+        elif sensor_pose is not None:
+            to_base = SE2.from_xy_theta(sensor_pose)
+        elif frame in sensor_poses:
+            to_base = sensor_poses[frame]
+        else:
+            continue
+        scan_stamps.append(stamp)
+        scan_points.append(to_base.apply(points))
+    return Recording.from_scans(odom_stamps, odom, scan_stamps, scan_points,
+                                initial_pose)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert a bag file to a replay.py recording")
+    parser.add_argument("bag", help="bag file with odometry and scans")
+    parser.add_argument("output", help="npz recording to write")
+    parser.add_argument("--odom-topic", default="/odom")
+    parser.add_argument("--scan-topic", default="/projected_stable_scan",
+                        help="sensor_msgs/PointCloud or sensor_msgs/LaserScan topic")
+    parser.add_argument("--base-frame", default="base_link")
+    parser.add_argument("--odom-frame", default="odom")
+    parser.add_argument("--sensor-pose", type=float, nargs=3,
+                        metavar=("X", "Y", "THETA"),
+                        help="pose of the scan frame in the base frame, if it is not in the bag")
+    parser.add_argument("--initial-pose", type=float, nargs=3,
+                        metavar=("X", "Y", "THETA"),
+                        help="map pose to store as the recording's initial pose")
+    args = parser.parse_args(argv)
+
+    recording = read_bag(args.bag, odom_topic=args.odom_topic,
+                         scan_topic=args.scan_topic,
+                         base_frame=args.base_frame,
+                         odom_frame=args.odom_frame,
+                         sensor_pose=args.sensor_pose,
+                         initial_pose=args.initial_pose)
+    save_recording(args.output, recording)
+    sys.stderr.write("%d scans and %d odometry poses written to %s\n"
+                     % (len(recording), len(recording.odom), args.output))
+
+
+if __name__ == '__main__':
+    main()
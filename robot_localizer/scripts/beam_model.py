@@ -0,0 +1,204 @@
+""" A beam (ray casting) sensor model.  Ray casting in Python is far too slow
+    to do per particle at scan rate, so the expected range from every free
+    map cell in each of a fixed number of headings is computed once per map,
+    cached to disk, and looked up in batch when scoring particles. """
+
+import numpy as np
+
+from field_cache import FieldCache, field_key
+from occupancy_field import OccupancyField
+from se2 import SE2
+
+
+def cast_rays(field, cells, n_headings, max_range):
+    """ Computes the range (in meters) to the first occupied cell along rays
+        cast from the center of each of cells (an array of (row, col)) of the
+        map of field in n_headings evenly spaced headings.  Rays that leave the
+        map or travel max_range without hitting anything get max_range.
+        Returns a len(cells) x n_headings float array. """
+    headings = 2*np.pi*np.arange(n_headings)/n_headings
+    return _march(field, cells[:, 1, np.newaxis] + 0.5,
+                  cells[:, 0, np.newaxis] + 0.5, headings, max_range)
+
+
+def trace_rays(field, x, y, headings, max_range):
+    """ Computes the range (in meters) to the first occupied cell along rays
+        from the map coordinates (x, y) in the directions headings.  The
+        arguments broadcast against each other and so does the result.
+        Rays that start outside the map, leave it or travel max_range
+        without hitting anything get max_range. """
+    return _march(field, (np.asarray(x) - field.origin[0])/field.resolution,
+                  (np.asarray(y) - field.origin[1])/field.resolution,
+                  headings, max_range)
+
+
+def _march(field, start_x, start_y, headings, max_range):
+    """ Marches rays from (start_x, start_y), in cells, in the directions
+        headings (all broadcast together) to the first occupied cell.
+        Returns the ranges in meters. """
+    occupied = field.grid > 0
+    height, width = occupied.shape
+    # distances to the closest obstacle in cells.  A ray can safely jump by
+    # this distance (less the extent of the two cells involved) without
+    # passing an obstacle, so most rays only need a handful of steps
+    clearance = np.asarray(field.closest_occ, dtype=np.float64) / \
+        field.resolution - np.sqrt(2)
+    max_cells = max_range/field.resolution
+
+    # one entry per ray, all marched together
+    start_x, start_y, headings = np.broadcast_arrays(start_x, start_y, headings)
+    shape = start_x.shape
+    start_x = start_x.ravel()
+    start_y = start_y.ravel()
+    cos_h = np.cos(headings).ravel()
+    sin_h = np.sin(headings).ravel()
+    travelled = np.zeros(len(start_x))
+    ranges = np.full(len(start_x), max_cells)
+
+    active = np.arange(len(start_x))
+    while len(active):
+        t = travelled[active]
+        col = np.floor(start_x[active] + t*cos_h[active]).astype(np.intp)
+        row = np.floor(start_y[active] + t*sin_h[active]).astype(np.intp)
+        inside = (col >= 0) & (col < width) & (row >= 0) & (row < height) & \
+            (t < max_cells)
+        active, t, row, col = active[inside], t[inside], row[inside], col[inside]
+        hit = occupied[row, col]
+        ranges[active[hit]] = t[hit]
+        active, t, row, col = active[~hit], t[~hit], row[~hit], col[~hit]
+        # never step less than a quarter of a cell so that rays rarely slip
+        # between the cells of diagonal walls
+        travelled[active] = t + np.maximum(clearance[row, col], 0.25)
+    ranges = np.minimum(ranges*field.resolution, max_range)
+    return ranges.reshape(shape)
+
+
+class BeamModel(object):
+    """ Scores particles with a beam sensor model using a precomputed table of
+        expected ranges
+        Attributes:
+            field: the OccupancyField whose map the rays are cast in
+            n_headings: the number of discrete headings in the table
+            max_range: the largest range in the table (meters)
+            cell_index: an int32 array indexed by [row, col] giving the row of
+            the range table for each free cell (-1 for other cells)
+            expected_ranges: a uint16 table of expected ranges in millimeters
+            indexed by [cell_index, heading]
+            laser_pose: the (x, y, theta) pose of the laser in the robot's
+            base frame.  Beams are cast from there, not from the base origin
+    """
+
+    def __init__(self, field, n_headings=72, max_range=5.0, cache=None,
+                 laser_pose=(0.0, 0.0, 0.0)):
+        """ Builds (or loads from cache, a FieldCache) the range table for the
+            map of field.  Pass cache=False to always rebuild it. """
+        self.field = field
+        self.n_headings = n_headings
+        self.max_range = max_range
+        self.laser_pose = laser_pose
+
+        free = np.argwhere(field.grid == 0)
+        self.cell_index = np.full(field.grid.shape, -1, dtype=np.int32)
+        self.cell_index[free[:, 0], free[:, 1]] = np.arange(len(free))
+
+        if cache is None:
+            cache = FieldCache()
+        key = field_key(field.grid, field.resolution, field.origin,
+                        kind="raycast-%d-%g" % (n_headings, max_range))
+        table = cache.load(key) if cache else None
+        if table is None or table.shape != (len(free), n_headings):
+            ranges = cast_rays(field, free, n_headings, max_range)
+            # quantize to millimeters
+            table = np.round(ranges*1000).astype(np.uint16)
+            if cache:
+                cache.store(key, table)
+        self.expected_ranges = table
+
+    def expected_range(self, x, y, heading):
+        """ Looks up the expected ranges for arrays of map coordinates and
+            beam headings.  Coordinates outside of the free space of the map
+            get nan. """
+        row, col, in_map = self.field._cell_indices(x, y)
+        index = np.full(row.shape, -1, dtype=np.int32)
+        index[in_map] = self.cell_index[row[in_map], col[in_map]]
+        bins = np.round(np.asarray(heading)*self.n_headings/(2*np.pi)) \
+            .astype(np.intp) % self.n_headings
+        index, bins = np.broadcast_arrays(index, bins)
+        ranges = np.full(index.shape, np.nan)
+        valid = index >= 0
+        ranges[valid] = self.expected_ranges[index[valid], bins[valid]]/1000.0
+        return ranges
+
+    def score_particles(self, poses, scan_xy, sigma=0.1, max_distance=2.0,
+                        z_hit=0.8, z_short=0.1, z_rand=0.1, lambda_short=0.5):
+        """ Scores every particle against a scan.  Takes the same arguments as
+            log_likelihoods.  Returns an array of N weights, scaled so that
+            the most likely particle has weight 1 (the product of many
+            per-beam likelihoods would otherwise underflow). """
+        log_likelihood = self.log_likelihoods(poses, scan_xy, sigma=sigma,
+                                              max_distance=max_distance,
+                                              z_hit=z_hit, z_short=z_short,
+                                              z_rand=z_rand,
+                                              lambda_short=lambda_short)
+        if len(log_likelihood) == 0:
+            return np.ones(0)
+        return np.exp(log_likelihood - np.max(log_likelihood))
+
+    def log_likelihoods(self, poses, scan_xy, sigma=0.1, max_distance=2.0,
+                        z_hit=0.8, z_short=0.1, z_rand=0.1, lambda_short=0.5):
+        """ Computes the log likelihood of a scan for every particle with the
+            beam model.  Takes the same arguments as
+            OccupancyField.log_likelihoods so that the two models are
+            interchangeable.
+
+            poses: an N x 3 array of particle poses (x, y, theta) in the map
+            frame
+            scan_xy: an M x 2 array of scan points in the robot's base frame
+            sigma: the standard deviation of the range noise (in meters)
+            max_distance: the largest range error that is penalized
+            z_hit, z_short, z_rand: the mixture weights of the measurement
+            noise, unexpected obstacle and random measurement components
+            lambda_short: the rate of the unexpected obstacle component
+
+            The scan points are moved into the laser frame (see laser_pose),
+            so that each beam is looked up along the ray the laser actually
+            measured.  Returns an array of the N log likelihoods of the scan.
+            Particles whose laser is outside the free space of the map score
+            every beam as a random measurement. """
+        poses = np.asarray(poses, dtype=np.float64).reshape((-1, 3))
+        scan_xy = np.asarray(scan_xy, dtype=np.float64).reshape((-1, 2))
+        n, m = poses.shape[0], scan_xy.shape[0]
+        if n == 0 or m == 0:
+            return np.zeros(n)
+
+        # range and bearing of each beam from the laser, and the pose of the
+        # laser in the map for each particle
+        laser = SE2.from_xy_theta(self.laser_pose)
+        scan_xy = laser.inverse().apply(scan_xy)
+        poses = (SE2.from_xy_theta(poses)*laser).xy_theta()
+        measured = np.minimum(np.hypot(scan_xy[:, 0], scan_xy[:, 1]),
+                              self.max_range)
+        bearing = np.arctan2(scan_xy[:, 1], scan_xy[:, 0])
+
+        log_likelihood = np.empty(n)
+        chunk = max(1, OccupancyField.SCORE_CHUNK_SIZE // m)
+        for start in range(0, n, chunk):
+            x, y, theta = poses[start:start + chunk].T[:, :, np.newaxis]
+            expected = self.expected_range(x, y, theta + bearing)
+            known = ~np.isnan(expected)
+            expected = np.where(known, expected, 0.0)
+
+            error = np.minimum(np.abs(measured - expected), max_distance)
+            # the unexpected obstacle density is normalized over [0, expected]
+            short = known & (measured < expected)
+            short_normalizer = np.zeros(expected.shape)
+            np.divide(1.0, -np.expm1(-lambda_short*expected),
+                      out=short_normalizer, where=short)
+            beam_likelihood = z_hit*known*np.exp(-0.5*(error/sigma)**2) + \
+                z_short*short*short_normalizer * \
+                lambda_short*np.exp(-lambda_short*measured) + \
+                z_rand/self.max_range
+            log_likelihood[start:start + chunk] = \
+                np.sum(np.log(beam_likelihood), axis=1)
+
+        return log_likelihood
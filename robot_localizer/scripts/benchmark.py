@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+""" Benchmarks each stage of the localization pipeline on the AC109 maps
+    without ROS.  Scans are synthesized by ray casting into the map from
+    poses along a ground truth trajectory through its free space.  Every
+    stage is timed on its own for a range of particle and beam counts and
+    the results are written as JSON, e.g.
+
+        benchmark.py -o before.json
+        ... change something ...
+        benchmark.py -o after.json --compare before.json
+
+    --compare reports the stages that got slower than the baseline by more
+    than --tolerance and exits with status 1 if there are any. """
+
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+from beam_model import BeamModel, trace_rays
+from field_cache import FieldCache, DEFAULT_CACHE_DIR
+from filter_core import FilterCore
+from global_localization import coarse_to_fine_poses
+from motion_model import OdometryMotionModel
+from se2 import angle_normalize
+from occupancy_field import OccupancyField
+from particle_cloud import ParticleCloud
+from placeParticles import placeParticles
+from scan_preprocessing import ScanPreprocessor
+import resampling
+
+DEFAULT_MAPS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             "..", "maps", "ac109_*.yaml")))
+DEFAULT_PARTICLES = (100, 1000, 10000, 50000)
+DEFAULT_BEAMS = (90, 180, 360)
+
+
+def ground_truth_trajectory(field, n_poses, rng, step=0.05, clearance=0.3):
+    """ Generates n_poses (x, y, theta) poses step meters apart that wander
+        through the free space of the map of field, keeping at least
+        clearance meters from obstacles """
+    row, col = np.nonzero((field.grid == 0) & (field.closest_occ >= clearance))
+    if len(row) == 0:
+        raise ValueError("the map has no free space with %gm of clearance" % clearance)
+    start = rng.integers(len(row))
+    x = field.origin[0] + (col[start] + 0.5)*field.resolution
+    y = field.origin[1] + (row[start] + 0.5)*field.resolution
+    theta = rng.uniform(-np.pi, np.pi)
+
+    # candidate turns, smallest first
+    turns = np.linspace(-np.pi, np.pi, 73)
+    turns = turns[np.argsort(np.abs(turns), kind="stable")]
+    poses = np.empty((n_poses, 3))
+    for i in range(n_poses):
+        poses[i] = x, y, theta
+        headings = theta + turns + rng.normal(0, 0.05)
+        ahead_x = x + step*np.cos(headings)
+        ahead_y = y + step*np.sin(headings)
+        r, c, in_map = field._cell_indices(ahead_x, ahead_y)
+        ok = in_map.copy()
+        ok[in_map] = (field.grid[r[in_map], c[in_map]] == 0) & \
+            (field.closest_occ[r[in_map], c[in_map]] >= clearance)
+        if not np.any(ok):
+            # boxed in: turn on the spot
+            theta = angle_normalize(theta + np.pi/2)
+            continue
+        best = np.argmax(ok)
+        x, y, theta = ahead_x[best], ahead_y[best], angle_normalize(headings[best])
+    return poses
+
+
+def synthesize_scan(field, pose, n_beams, rng, max_range=5.0, noise=0.01):
+    """ Simulates a 360 degree scan of n_beams beams taken at pose.  Returns
+        the M x 2 array of scan points in the robot's base frame (beams that
+        hit nothing within max_range are dropped) """
+    bearings = 2*np.pi*np.arange(n_beams)/n_beams
+    ranges = trace_rays(field, pose[0], pose[1], pose[2] + bearings, max_range)
+    hit = ranges < max_range
+    ranges = ranges + rng.normal(0, noise, n_beams)
+    return np.column_stack((ranges[hit]*np.cos(bearings[hit]),
+                            ranges[hit]*np.sin(bearings[hit])))
+
+
+def time_stage(run, repeats, setup=None):
+    """ Times run(*setup()) repeats times after one warm up call (or just
+        once, with repeats=0).  setup (untimed) prepares the arguments of each
+        call.  Returns a dict of the timing statistics in milliseconds """
+    times = []
+    for i in range(repeats + 1):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        run(*args)
+        times.append(1000*(time.perf_counter() - start))
+    if repeats > 0:
+        # drop the warm up call
+        times = times[1:]
+    return {"repeats": len(times),
+            "min_ms": float(np.min(times)),
+            "median_ms": float(np.median(times)),
+            "mean_ms": float(np.mean(times)),
+            "max_ms": float(np.max(times))}
+
+
+def particles_around(pose, n, rng, xy_std=0.3, theta_std=0.3):
+    """ A ParticleCloud of n particles normally distributed around pose """
+    return ParticleCloud.from_arrays(rng.normal(pose[0], xy_std, n),
+                                     rng.normal(pose[1], xy_std, n),
+                                     angle_normalize(rng.normal(pose[2], theta_std, n)))
+
+
+def benchmark_map(map_path, particle_counts, beam_counts, repeats, rng,
+                  sensor_models=("likelihood_field",), cache=None, report=None):
+    """ Runs every stage benchmark on one map.  Returns a list of result
+        dicts with the map, stage, particle and beam counts and timings.
+        report, if given, is called with each result as it is produced """
+    results = []
+    name = os.path.splitext(os.path.basename(map_path))[0]
+
+    def record(stage, timing, particles=None, beams=None):
+        result = dict(map=name, stage=stage, particles=particles, beams=beams, **timing)
+        results.append(result)
+        if report is not None:
+            report(result)
+
+    field = OccupancyField.from_yaml(map_path, cache=cache)
+    record("field_build", time_stage(lambda: OccupancyField.compute_distance_field(field.grid, field.resolution),
+                                     max(1, repeats//2)))
+    models = {}
+    for sensor_model in sensor_models:
+        if sensor_model == "beam":
+            # the table takes seconds to build, so it is only built (uncached) once
+            record("beam_table_build", time_stage(lambda: models.__setitem__("beam", BeamModel(field, cache=False)),
+                                                  0))
+        elif sensor_model == "likelihood_field":
+            models["likelihood_field"] = field
+        else:
+            raise ValueError("unknown sensor model %r" % sensor_model)
+
+    trajectory = ground_truth_trajectory(field, 20, rng)
+    odom_before, odom_after = trajectory[-2], trajectory[-1]
+    scans = dict((m, synthesize_scan(field, odom_after, m, rng)) for m in beam_counts)
+    motion_model = OdometryMotionModel(rng=rng)
+
+    def build_pyramid():
+        field._pyramid = None
+        field.pyramid()
+    record("pyramid_build", time_stage(build_pyramid, repeats))
+    for m in beam_counts:
+        scan = ScanPreprocessor().process(scans[m])
+        record("global_localization", time_stage(lambda: coarse_to_fine_poses(field, scan, 1000, rng),
+                                                 max(1, repeats//2)), 1000, m)
+
+    placer = placeParticles(rng=rng)
+    for n in particle_counts:
+        cloud = particles_around(odom_after, n, rng)
+
+        reused = ParticleCloud(n)
+        record("initialization", time_stage(lambda: placer.createRandomXYs(odom_after[0], odom_after[1],
+                                                                           odom_after[2], n, reused), repeats), n)
+        record("uniform_initialization", time_stage(lambda: placer.createUniformXYs(field, n, reused), repeats), n)
+
+        record("motion_update", time_stage(lambda poses: motion_model.sample(poses, odom_before, odom_after),
+                                           repeats, setup=lambda: (cloud.poses.copy(),)), n)
+
+        for sensor_model, model in sorted(models.items()):
+            for m in beam_counts:
+                stage = "weighting" if sensor_model == "likelihood_field" else "weighting_%s" % sensor_model
+                record(stage, time_stage(lambda: model.score_particles(cloud.poses, scans[m]), repeats), n, m)
+
+        m = beam_counts[len(beam_counts)//2]
+        cloud.w[:] = field.score_particles(cloud.poses, scans[m])
+        cloud.normalize_weights()
+        record("normalization", time_stage(lambda c: c.normalize_weights(), repeats,
+                                           setup=lambda: (ParticleCloud.from_arrays(cloud.x, cloud.y, cloud.theta,
+                                                                                    cloud.w*3.0),)), n)
+        record("resampling", time_stage(lambda: resampling.resample(cloud.w, n, rng), repeats), n)
+        record("kld_resampling", time_stage(lambda: resampling.kld_resample(cloud.w, cloud.poses, rng, 100,
+                                                                            max(n, 100)), repeats), n)
+        record("pose_estimate", time_stage(lambda: cloud.covariance(cloud.mean_pose()), repeats), n)
+        record("mode_estimate", time_stage(lambda: cloud.mean_pose(cloud.cluster_weights()), repeats), n)
+        record("publish_conversion", time_stage(cloud.planar_pose_arrays, repeats), n)
+
+        for m in beam_counts:
+            def setup():
+                core = FilterCore(field, n_particles=n, rng=rng, kld_sampling=False,
+                                  scan_preprocessor=ScanPreprocessor(strategy="none"))
+                core.initialize(odom_after)
+                core.update_odometry(odom_before)
+                return (core,)
+            record("filter_step", time_stage(lambda core: core.step(odom_after, scans[m]), repeats, setup=setup),
+                   n, m)
+    return results
+
+
+def result_key(result):
+    return (result["map"], result["stage"], result["particles"], result["beams"])
+
+
+def compare(results, baseline, tolerance):
+    """ Returns (result, baseline result) pairs for the stages whose median
+        time grew by more than the fraction tolerance """
+    previous = dict((result_key(result), result) for result in baseline)
+    regressions = []
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is not None and result["median_ms"] > (1 + tolerance)*old["median_ms"]:
+            regressions.append((result, old))
+    return regressions
+
+
+def format_result(result):
+    return "%-10s %-20s %8s particles %5s beams %10.3f ms" % (
+        result["map"], result["stage"],
+        "-" if result["particles"] is None else result["particles"],
+        "-" if result["beams"] is None else result["beams"],
+        result["median_ms"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the localization pipeline stages")
+    parser.add_argument("--maps", nargs="+", default=DEFAULT_MAPS, help="map_server style map files")
+    parser.add_argument("--particles", type=int, nargs="+", default=DEFAULT_PARTICLES)
+    parser.add_argument("--beams", type=int, nargs="+", default=DEFAULT_BEAMS)
+    parser.add_argument("--sensor-models", nargs="+", default=["likelihood_field"],
+                        choices=("likelihood_field", "beam"))
+    parser.add_argument("--repeats", type=int, default=5, help="timed runs per benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--field-cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("-o", "--output", help="file to write the JSON results to (default stdout)")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown (as a fraction of the baseline median) reported as a regression")
+    args = parser.parse_args(argv)
+    if not args.maps:
+        parser.error("no maps found; pass --maps")
+
+    rng = np.random.default_rng(args.seed)
+    cache = FieldCache(args.field_cache_dir)
+    report = lambda result: sys.stderr.write(format_result(result) + "\n")
+    results = []
+    for map_path in args.maps:
+        results.extend(benchmark_map(map_path, args.particles, args.beams, args.repeats, rng,
+                                     sensor_models=args.sensor_models, cache=cache, report=report))
+
+    output = {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "python": platform.python_version(),
+                       "numpy": np.__version__,
+                       "machine": platform.machine(),
+                       "processor": platform.processor(),
+                       "cpu_count": os.cpu_count(),
+                       "seed": args.seed,
+                       "repeats": args.repeats},
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=1, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for result, old in regressions:
+            sys.stderr.write("regression: %s (was %.3f ms)\n" % (format_result(result), old["median_ms"]))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
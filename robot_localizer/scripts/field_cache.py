@@ -0,0 +1,124 @@
+""" An on-disk cache of precomputed occupancy fields.  Fields are stored as
+    .npy files named by a hash of the map contents and metadata so that
+    restarting the localizer on a map it has seen before skips the distance
+    computation entirely. """
+
+import hashlib
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+# bump this whenever the way the distance field is computed changes so that
+# stale cache entries are never reused
+FIELD_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("ROS_HOME", os.path.join(os.path.expanduser("~"), ".ros")),
+    "robot_localizer", "field_cache")
+
+# a cache directory on a tmpfs.  Memory mapping fields from here shares
+# them between processes without any disk I/O
+SHARED_CACHE_DIR = "/dev/shm/robot_localizer"
+
+DEFAULT_MAX_BYTES = 512*1024*1024
+
+
+def field_key(grid, resolution, origin, kind="distance"):
+    """ Computes the cache key of a field derived from a map.
+        grid: the [row, col] array of occupancy values
+        resolution: the map resolution (meters per cell)
+        origin: the (x, y) position of the map origin
+        kind: a name for the type of field derived from the map """
+    grid = np.ascontiguousarray(grid, dtype=np.int8)
+    digest = hashlib.sha1()
+    digest.update(kind.encode())
+    digest.update(struct.pack("<I3d2q", FIELD_VERSION, resolution,
+                              origin[0], origin[1],
+                              grid.shape[0], grid.shape[1]))
+    digest.update(grid.tobytes())
+    return "%s-%s" % (kind, digest.hexdigest())
+
+
+class FieldCache(object):
+    """ A size bounded directory of cached fields with least recently used
+        eviction
+        Attributes:
+            cache_dir: the directory holding the cached .npy files
+            max_bytes: the total size the cache is trimmed to after each store
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        """ Returns the file that holds the field for key """
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def load(self, key, mmap_mode=None):
+        """ Returns the cached field for key or None if it is not cached.
+            mmap_mode is passed through to np.load """
+        path = self.path(key)
+        try:
+            field = np.load(path, mmap_mode=mmap_mode)
+        except (IOError, OSError, ValueError):
+            return None
+        # mark the entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return field
+
+    def store(self, key, field):
+        """ Atomically writes field to the cache under key and then evicts the
+            least recently used entries until the cache fits in max_bytes.
+            Failing to write the cache is not fatal; the path of the stored
+            file is returned or None if it could not be written """
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, np.ascontiguousarray(field))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path(key))
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except (IOError, OSError):
+            return None
+        self.evict(keep=key)
+        return self.path(key)
+
+    def evict(self, keep=None):
+        """ Removes the least recently used entries until the total size of
+            the cache is at most max_bytes.  The entry for keep is never
+            removed.  Processes that have an evicted field memory mapped keep
+            their mapping; the file is only freed once they exit """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        keep_path = self.path(keep) if keep is not None else None
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep_path:
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,245 @@
+""" The particle filter itself, free of any ROS dependencies.  pf_scaffold.py
+    wraps a FilterCore in a ROS node (tf, topics and parameters); replay.py
+    drives one from recorded data without a ROS master. """
+
+import numpy as np
+
+from particle_cloud import ParticleCloud
+from placeParticles import placeParticles
+import resampling
+from global_localization import coarse_to_fine_poses
+from instrumentation import Instrumentation
+from motion_model import OdometryMotionModel
+from se2 import angle_normalize
+from scan_preprocessing import ScanPreprocessor
+
+
+class FilterCore(object):
+    """ A particle filter over (x, y, theta) poses in the map frame
+        Attributes:
+            sensor_model: the model used to weight particles against a scan
+            (anything with a score_particles method, e.g. an OccupancyField, a
+            ParallelScorer or a BeamModel)
+            n_particles: the number of particles in the filter (the initial
+            number when kld_sampling is enabled)
+            rng: the numpy random Generator used by the filter
+            motion_model: the OdometryMotionModel used to move the particles
+            between scans
+            scan_preprocessor: the ScanPreprocessor that filters and
+            downsamples each scan
+            d_thresh: the amount of linear movement before the particles are
+            weighted
+            a_thresh: the amount of angular movement before the particles are
+            weighted
+            sigma_hit: the standard deviation of the Gaussian in the sensor
+            model
+            laser_max_distance: the maximum distance to an obstacle we should
+            use in a likelihood calculation
+            resample_method: the name of the resampling scheme to use (see
+            resampling.RESAMPLERS)
+            resample_threshold: the filter resamples when the effective sample
+            size drops below this fraction of the cloud size
+            kld_sampling: whether resampling adapts the number of particles
+            with KLD sampling, between kld_min_particles and kld_max_particles
+            kld_bin_size, kld_epsilon, kld_z: the parameters of KLD sampling
+            (see resampling.kld_resample)
+            pose_estimate: how the pose estimate is computed from the cloud,
+            "mean" (the weighted mean) or "mode" (the weighted mean of the
+            heaviest cluster of particles, see ParticleCloud.cluster_weights)
+            mode_bin_size: the (x, y, theta) cell size used for clustering
+            placer: the placeParticles that samples new clouds (around a pose
+            with a spread of init_xy_std and init_theta_std, or uniformly)
+            instrumentation: the Instrumentation the filter stages are timed
+            with
+            particle_cloud: a ParticleCloud representing a probability
+            distribution over robot poses
+            odom_xy_theta: the odometry pose (x, y, theta) the particles were
+            last moved to, None before the first update
+            started_moving: whether the robot has moved since the filter
+            started
+            estimate: the latest (x, y, theta) estimate of the robot's pose
+            covariance: the 3 x 3 covariance of the particles (of the cluster
+            for the mode estimate) about estimate
+            ess: the effective sample size after the latest update
+    """
+
+    def __init__(self, sensor_model, n_particles=400, rng=None,
+                 motion_model=None, scan_preprocessor=None,
+                 d_thresh=0.002, a_thresh=0.00001, sigma_hit=0.1,
+                 laser_max_distance=2.0, resample_method="systematic",
+                 resample_threshold=0.5, kld_sampling=True,
+                 kld_min_particles=100, kld_max_particles=5000,
+                 kld_bin_size=(0.25, 0.25, np.pi/18), kld_epsilon=0.05,
+                 kld_z=2.326, init_xy_std=0.4, init_theta_std=0.5,
+                 pose_estimate="mean", mode_bin_size=(0.25, 0.25, np.pi/9),
+                 instrumentation=None):
+        if pose_estimate not in ("mean", "mode"):
+            raise ValueError("unknown pose estimate %r (expected mean or mode)"
+                             % pose_estimate)
+        self.sensor_model = sensor_model
+        self.n_particles = n_particles
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.motion_model = motion_model if motion_model is not None \
+            else OdometryMotionModel(rng=self.rng)
+        self.scan_preprocessor = scan_preprocessor if scan_preprocessor is not None \
+            else ScanPreprocessor(rng=self.rng)
+        self.d_thresh = d_thresh
+        self.a_thresh = a_thresh
+        self.sigma_hit = sigma_hit
+        self.laser_max_distance = laser_max_distance
+        self.resample_method = resample_method
+        self.resample_threshold = resample_threshold
+        self.kld_sampling = kld_sampling
+        self.kld_min_particles = kld_min_particles
+        self.kld_max_particles = kld_max_particles
+        self.kld_bin_size = tuple(kld_bin_size)
+        self.kld_epsilon = kld_epsilon
+        self.kld_z = kld_z
+        self.pose_estimate = pose_estimate
+        self.mode_bin_size = tuple(mode_bin_size)
+        self.placer = placeParticles(rng=self.rng, xy_std=init_xy_std,
+                                     theta_std=init_theta_std)
+        self.instrumentation = instrumentation if instrumentation is not None \
+            else Instrumentation()
+
+        self.particle_cloud = ParticleCloud()
+        self.odom_xy_theta = None
+        self.started_moving = False
+        self.estimate = np.zeros(3)
+        self.covariance = np.zeros((3, 3))
+        self.ess = 0.0
+
+    def initialize(self, xy_theta, n_particles=None):
+        """ Replaces the cloud with n_particles (self.n_particles by default)
+            particles normally distributed around the (x, y, theta) pose
+            xy_theta """
+        n = self.n_particles if n_particles is None else n_particles
+        # the arrays of the current cloud are reused when it has n particles
+        self.particle_cloud = self.placer.createRandomXYs(
+            xy_theta[0], xy_theta[1], xy_theta[2], n, self.particle_cloud)
+        self.estimate_pose()
+
+    def initialize_uniform(self, field, n_particles=None):
+        """ Replaces the cloud with n_particles (self.n_particles by default)
+            particles spread uniformly over the free space of the map of field
+            (an OccupancyField) """
+        n = self.n_particles if n_particles is None else n_particles
+        self.particle_cloud = self.placer.createUniformXYs(
+            field, n, self.particle_cloud)
+        self.estimate_pose()
+
+    def initialize_global(self, field, scan_xy, n_particles=None):
+        """ Replaces the cloud with n_particles (self.n_particles by default)
+            particles at the poses anywhere in the map of field (an
+            OccupancyField) that best explain scan_xy (an M x 2 array of points
+            in the robot's base frame).  See global_localization.py """
+        n = self.n_particles if n_particles is None else n_particles
+        with self.instrumentation.stage("global_localization"):
+            poses = coarse_to_fine_poses(
+                field, self.scan_preprocessor.process(scan_xy), n, self.rng,
+                sigma=self.sigma_hit, max_distance=self.laser_max_distance)
+        self.particle_cloud = ParticleCloud.from_arrays(poses[:, 0],
+                                                        poses[:, 1],
+                                                        poses[:, 2])
+        self.particle_cloud.normalize_weights()
+        self.estimate_pose()
+
+    def update_odometry(self, odom_xy_theta):
+        """ Moves every particle by a noisy sample of the odometry motion from
+            the odometry pose of the last motion update to odom_xy_theta.
+            Returns whether the robot moved far enough for the particles to be
+            moved and weighted. """
+        old_odom_xy_theta = self.odom_xy_theta
+        if old_odom_xy_theta is None:
+            self.odom_xy_theta = tuple(odom_xy_theta)
+            return False
+
+        dx = odom_xy_theta[0] - old_odom_xy_theta[0]
+        dy = odom_xy_theta[1] - old_odom_xy_theta[1]
+        da = angle_normalize(odom_xy_theta[2] - old_odom_xy_theta[2])
+        moved = abs(dx) >= self.d_thresh or abs(dy) >= self.d_thresh or \
+            abs(da) >= self.a_thresh
+        if moved:
+            # motion below the thresholds is kept for the next update
+            # rather than dropped
+            self.odom_xy_theta = tuple(odom_xy_theta)
+            self.started_moving = True
+            with self.instrumentation.stage("motion_update"):
+                self.motion_model.sample(self.particle_cloud.poses,
+                                         old_odom_xy_theta, odom_xy_theta)
+        else:
+            self.instrumentation.count("scans_without_motion")
+        return moved
+
+    def update_scan(self, scan_xy, moved=True):
+        """ Weights the particles against a scan (an M x 2 array of points in
+            the robot's base frame) if the robot moved, then normalizes the
+            weights and updates estimate and ess.  The scan is filtered and
+            downsampled once here; the result is shared by every particle. """
+        instrumentation = self.instrumentation
+        if moved:
+            with instrumentation.stage("scan_preprocessing"):
+                scan_xy = self.scan_preprocessor.process(scan_xy)
+            # score every particle against every scan point in one batched
+            # call.  weights carry over multiplicatively between resamples
+            with instrumentation.stage("weighting"):
+                self.particle_cloud.w[:] *= self.sensor_model.score_particles(
+                    self.particle_cloud.poses, scan_xy, sigma=self.sigma_hit,
+                    max_distance=self.laser_max_distance)
+        with instrumentation.stage("normalization"):
+            self.particle_cloud.normalize_weights()
+            self.ess = self.particle_cloud.effective_sample_size()
+        with instrumentation.stage("pose_estimate"):
+            self.estimate_pose()
+
+    def estimate_pose(self):
+        """ Updates estimate and covariance from the particle cloud """
+        cloud = self.particle_cloud
+        weights = None
+        if self.pose_estimate == "mode":
+            weights = cloud.cluster_weights(self.mode_bin_size)
+        self.estimate = cloud.mean_pose(weights)
+        self.covariance = cloud.covariance(self.estimate, weights)
+
+    def needs_resample(self):
+        """ Whether the weights have degenerated enough to resample """
+        return self.started_moving and \
+            self.ess < self.resample_threshold*len(self.particle_cloud)
+
+    def resample(self):
+        """ Resample the particles according to their weights with the scheme
+            self.resample_method.  Returns whether the weights were degenerate
+            (NaN, negative or all zero) and had to be repaired first. """
+        with self.instrumentation.stage("resampling"):
+            degenerate = self._resample()
+        if degenerate:
+            self.instrumentation.count("degenerate_weights")
+        return degenerate
+
+    def _resample(self):
+        if self.kld_sampling:
+            # let the spread of the particles decide how many we need
+            indices, degenerate = resampling.kld_resample(
+                self.particle_cloud.w, self.particle_cloud.poses, self.rng,
+                self.kld_min_particles, self.kld_max_particles,
+                bin_size=self.kld_bin_size, epsilon=self.kld_epsilon,
+                z=self.kld_z, method=self.resample_method)
+        else:
+            indices, degenerate = resampling.resample(
+                self.particle_cloud.w, self.n_particles, self.rng,
+                method=self.resample_method)
+        self.particle_cloud.resample(indices)
+        return degenerate
+
+    def step(self, odom_xy_theta, scan_xy):
+        """ Runs a whole filter update for a scan (an M x 2 array of points
+            in the robot's base frame) taken at odometry pose odom_xy_theta.
+            A filter that has no particles yet is initialized around the
+            odometry pose.  Returns the pose estimate. """
+        moved = self.update_odometry(odom_xy_theta)
+        if not(len(self.particle_cloud)):
+            self.initialize(odom_xy_theta)
+        self.update_scan(scan_xy, moved)
+        if self.needs_resample():
+            self.resample()
+        return self.estimate
@@ -0,0 +1,95 @@
+""" Global localization: finds the robot anywhere in the map from a single
+    scan.  A dense grid of poses over the free space is scored against the
+    coarsest level of the occupancy field's resolution pyramid; only the best
+    hypotheses are refined and rescored at each finer level, and the
+    survivors of the full resolution level become the particles. """
+
+import numpy as np
+
+import resampling
+from se2 import angle_normalize
+
+
+def _best(poses, log_likelihood, keep):
+    """ Keeps the keep most likely of the hypotheses """
+    if len(poses) <= keep:
+        return poses, log_likelihood
+    best = np.argpartition(log_likelihood, -keep)[-keep:]
+    return poses[best], log_likelihood[best]
+
+
+def _in_free_space(level, poses):
+    """ Mask of the poses whose cell of level contains free space """
+    row, col, in_map = level._cell_indices(poses[:, 0], poses[:, 1])
+    free = in_map.copy()
+    free[in_map] = level.free[row[in_map], col[in_map]]
+    return free
+
+
+def coarse_to_fine_poses(field, scan_xy, n_particles, rng, n_headings=72,
+                         keep=2000, sigma=0.1, max_distance=2.0,
+                         factors=(1, 4, 16)):
+    """ Searches the whole map for the poses that best explain a scan.
+
+        field: the OccupancyField of the map
+        scan_xy: an M x 2 array of (preprocessed) scan points in the robot's
+        base frame
+        n_particles: the number of poses to return
+        rng: the numpy random Generator used to draw the poses
+        n_headings: the number of headings tried at each coarse position
+        keep: the number of hypotheses promoted to the next finer level
+        sigma, max_distance: the likelihood field parameters.  Coarser
+        levels widen sigma by their cell size.
+        factors: the levels of field.pyramid to search, finest first
+
+        Returns an n_particles x 3 array of (x, y, theta) poses drawn from the
+        surviving full resolution hypotheses in proportion to their
+        likelihood. """
+    levels = field.pyramid(factors)[::-1]
+    coarsest = levels[0]
+
+    # every heading at the center of every coarse cell with free space
+    rows, cols = np.nonzero(coarsest.free)
+    x = coarsest.origin[0] + (cols + 0.5)*coarsest.resolution
+    y = coarsest.origin[1] + (rows + 0.5)*coarsest.resolution
+    heading_step = 2*np.pi/n_headings
+    headings = np.arange(n_headings)*heading_step
+    poses = np.empty((len(x), n_headings, 3))
+    poses[:, :, 0] = x[:, np.newaxis]
+    poses[:, :, 1] = y[:, np.newaxis]
+    poses[:, :, 2] = angle_normalize(headings)
+    poses = poses.reshape((-1, 3))
+
+    cell_size = coarsest.resolution
+    log_likelihood = None
+    for i, level in enumerate(levels):
+        if i > 0:
+            # split each surviving hypothesis into the cells of this level
+            # that cover its cell, at two headings that halve the heading step
+            split = int(round(cell_size/level.resolution))
+            offsets = ((np.arange(split) + 0.5)/split - 0.5)*cell_size
+            dx, dy = [d.ravel() for d in np.meshgrid(offsets, offsets)]
+            dtheta = np.array([-0.25, 0.25])*heading_step
+            children = np.repeat(poses, len(dx)*len(dtheta), axis=0).reshape(
+                (len(poses), len(dx), len(dtheta), 3))
+            children[:, :, :, 0] += dx[:, np.newaxis]
+            children[:, :, :, 1] += dy[:, np.newaxis]
+            children[:, :, :, 2] = angle_normalize(children[:, :, :, 2] + dtheta)
+            poses = children.reshape((-1, 3))
+            cell_size = level.resolution
+            heading_step /= 2
+        poses = poses[_in_free_space(level, poses)]
+        level_sigma = sigma if level.factor == 1 else np.hypot(sigma, cell_size)
+        log_likelihood = level.log_likelihoods(poses, scan_xy, sigma=level_sigma,
+                                               max_distance=max_distance)
+        poses, log_likelihood = _best(poses, log_likelihood, keep)
+
+    if len(poses) == 0:
+        raise ValueError("the map has no free space to localize in")
+    weights, _ = resampling.sanitize_weights(np.exp(log_likelihood - np.max(log_likelihood)))
+    indices = resampling.systematic_resample(weights, n_particles, rng)
+    # spread the particles over the cell and heading bin of their hypothesis
+    jitter = rng.uniform(-0.5, 0.5, (n_particles, 3))*[cell_size, cell_size, heading_step]
+    particles = poses[indices] + jitter
+    particles[:, 2] = angle_normalize(particles[:, 2])
+    return particles
@@ -6,6 +6,7 @@ import math, rospy
 from visualization_msgs.msg import Marker
 from visualization_msgs.msg import MarkerArray
 from tf.transformations import euler_from_quaternion
+from se2 import SE2
 
 def create_marker(frame, ns, posx, posy, posz=0, mtype=Marker.SPHERE, \
                   scalex=.2, scaley=.2, scalez=.2, r=0, g=1, b=0, a=1, maction=3):
@@ -52,8 +53,7 @@ def neato_to_odom(a, b, c, d, theta):
         d: y of neato in world
         theta: the rotation neato is to the world
     """
-    r_x = math.cos(theta) * a - math.sin(theta) * b + c
-    r_y = math.sin(theta) * a + math.cos(theta) * b + d
+    r_x, r_y = SE2(c, d, theta).apply((a, b))
     return r_x, r_y
 
 # Helper Functions for angle calcs
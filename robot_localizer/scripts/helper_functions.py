@@ -3,23 +3,25 @@
 
 import rospy
 
-from std_msgs.msg import Header
-from geometry_msgs.msg import PoseStamped, Pose, Point, Quaternion
+from geometry_msgs.msg import Pose, Point, Quaternion
 
 import tf.transformations as t
-from tf import TransformListener
 from tf import TransformBroadcaster
 
 import math
 
+from se2 import SE2
+
 
 class TFHelper(object):
     """ TFHelper Provides functionality to convert poses between various
         forms, compare angles in a suitable way, and publish needed
         transforms to ROS """
     def __init__(self):
-        self.tf_listener = TransformListener()
         self.tf_broadcaster = TransformBroadcaster()
+        # the latest map -> odom transform (an SE2) and when it was last sent
+        self.map_to_odom = None
+        self.last_sent = None
 
     def convert_translation_rotation_to_pose(self, translation, rotation):
         """ Convert from representation of a pose as translation and rotation
@@ -32,20 +34,27 @@ class TFHelper(object):
                                            z=rotation[2],
                                            w=rotation[3]))
 
+    def convert_translation_rotation_to_se2(self, translation, rotation):
+        """ Convert from representation of a pose as translation and rotation
+            (Quaternion) tuples to the SE2 of its planar (x, y, yaw) part """
+        return SE2(translation[0], translation[1],
+                   t.euler_from_quaternion(rotation)[2])
+
+    def convert_se2_to_translation_rotation(self, transform):
+        """ Convert an SE2 to translation and rotation (Quaternion) tuples """
+        return ((transform.x, transform.y, 0.0),
+                (0.0, 0.0, math.sin(transform.theta/2.0),
+                 math.cos(transform.theta/2.0)))
+
+    def convert_pose_to_se2(self, pose):
+        """ Convert pose (geometry_msgs.Pose) to an SE2 """
+        return SE2(*self.convert_pose_to_xy_and_theta(pose))
+
     def convert_pose_inverse_transform(self, pose):
-        """ This is a helper method to invert a transform (this is built into
-            the tf C++ classes, but ommitted from Python) """
-        transform = t.concatenate_matrices(
-            t.translation_matrix([pose.position.x,
-                                  pose.position.y,
-                                  pose.position.z]),
-            t.quaternion_matrix([pose.orientation.x,
-                                 pose.orientation.y,
-                                 pose.orientation.z,
-                                 pose.orientation.w]))
-        inverse_transform_matrix = t.inverse_matrix(transform)
-        return (t.translation_from_matrix(inverse_transform_matrix),
-                t.quaternion_from_matrix(inverse_transform_matrix))
+        """ This is a helper method to invert a planar transform (this is
+            built into the tf C++ classes, but ommitted from Python) """
+        return self.convert_se2_to_translation_rotation(
+            self.convert_pose_to_se2(pose).inverse())
 
     def convert_pose_to_xy_and_theta(self, pose):
         """ Convert pose (geometry_msgs.Pose) to a (x,y,yaw) tuple """
@@ -80,34 +89,36 @@ class TFHelper(object):
         else:
             return d2
 
-    def fix_map_to_odom_transform(self, robot_pose, timestamp):
+    def fix_map_to_odom_transform(self, robot_xy_theta, odom_xy_theta):
         """ This method constantly updates the offset of the map and
             odometry coordinate systems based on the latest results from
             the localizer.
 
-            robot_pose should be of type geometry_msgs/Pose and timestamp is of
-            type rospy.Time and represents the time at which the robot's pose
-            corresponds.
+            robot_xy_theta is the estimated (x, y, theta) pose of the robot
+            in the map and odom_xy_theta the odometry pose of the robot at
+            the same time.  map -> odom is then map -> base_link composed
+            with the inverse of odom -> base_link, computed in closed form
+            without waiting on tf.
             """
-        (translation, rotation) = \
-            self.convert_pose_inverse_transform(robot_pose)
-        p = PoseStamped(
-            pose=self.convert_translation_rotation_to_pose(translation,
-                                                           rotation),
-            header=Header(stamp=timestamp, frame_id='base_link'))
-        self.tf_listener.waitForTransform('base_link',
-                                          'odom',
-                                          timestamp,
-                                          rospy.Duration(1.0))
-        self.odom_to_map = self.tf_listener.transformPose('odom', p)
-        (self.translation, self.rotation) = \
-            self.convert_pose_inverse_transform(self.odom_to_map.pose)
-
-    def send_last_map_to_odom_transform(self):
-        if not(hasattr(self, 'translation') and hasattr(self, 'rotation')):
+        self.map_to_odom = SE2.from_xy_theta(robot_xy_theta) * \
+            SE2.from_xy_theta(odom_xy_theta).inverse()
+
+    def send_last_map_to_odom_transform(self, max_age=None):
+        """ Broadcast the latest map to odom transform.  If max_age (a
+            rospy.Duration) is given the transform is only broadcast when it
+            was last sent longer ago than that, so a periodic rebroadcast does
+            not repeat the transforms sent with each new estimate. """
+        if self.map_to_odom is None:
+            return
+        now = rospy.get_rostime()
+        if max_age is not None and self.last_sent is not None and \
+                now - self.last_sent < max_age:
             return
-        self.tf_broadcaster.sendTransform(self.translation,
-                                          self.rotation,
-                                          rospy.get_rostime(),
+        translation, rotation = \
+            self.convert_se2_to_translation_rotation(self.map_to_odom)
+        self.tf_broadcaster.sendTransform(translation,
+                                          rotation,
+                                          now,
                                           'odom',
                                           'map')
+        self.last_sent = now
@@ -0,0 +1,112 @@
+""" Low overhead timing of the filter stages.  Each stage keeps the durations
+    of its most recent runs in a fixed size ring buffer; percentiles are only
+    computed when a summary is asked for, so timing a stage costs two clock
+    reads and an array store. """
+
+import json
+import time
+
+import numpy as np
+
+
+class RollingWindow(object):
+    """ The most recent samples of a quantity
+        Attributes:
+            samples: a ring buffer of the last len(samples) values
+            count: the total number of values ever added
+    """
+
+    def __init__(self, size):
+        self.samples = np.zeros(size)
+        self.count = 0
+
+    def add(self, value):
+        self.samples[self.count % len(self.samples)] = value
+        self.count += 1
+
+    def values(self):
+        """ The values currently in the window, in no particular order """
+        return self.samples[:min(self.count, len(self.samples))]
+
+
+class _StageTimer(object):
+    """ Context manager that adds the time spent in its block to a stage """
+    __slots__ = ('_window', '_clock', '_start')
+
+    def __init__(self, window, clock):
+        self._window = window
+        self._clock = clock
+
+    def __enter__(self):
+        self._start = self._clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._window.add(self._clock() - self._start)
+        return False
+
+
+class Instrumentation(object):
+    """ Rolling per stage timings and event counters for the filter
+        Attributes:
+            window: the number of recent runs of each stage kept for the
+            percentiles
+            stages: the RollingWindow of durations (seconds) of each stage, by
+            name, in the order the stages first ran
+            counters: event counts (e.g. skipped scans) by name
+    """
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, window=500, clock=time.perf_counter):
+        self.window = window
+        self.clock = clock
+        self.stages = {}
+        self.counters = {}
+
+    def _window(self, name):
+        window = self.stages.get(name)
+        if window is None:
+            window = self.stages[name] = RollingWindow(self.window)
+        return window
+
+    def stage(self, name):
+        """ Returns a context manager that times its block as a run of the
+            stage name:
+
+                with instrumentation.stage("weighting"):
+                    ...
+        """
+        return _StageTimer(self._window(name), self.clock)
+
+    def record(self, name, seconds):
+        """ Records a run of stage name that took seconds """
+        self._window(name).add(seconds)
+
+    def count(self, name, n=1):
+        """ Adds n to the counter name """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        """ Returns a dict with, for each stage, the number of runs and the
+            mean, max and p50/p95/p99 of the recent durations in milliseconds,
+            and the counters """
+        stages = {}
+        # the stages may be added to by another thread while this runs
+        for name, window in list(self.stages.items()):
+            values = window.values()*1000
+            if len(values) == 0:
+                continue
+            stage = {"runs": window.count,
+                     "mean_ms": float(np.mean(values)),
+                     "max_ms": float(np.max(values))}
+            for percentile, value in zip(self.PERCENTILES,
+                                         np.percentile(values, self.PERCENTILES)):
+                stage["p%d_ms" % percentile] = float(value)
+            stages[name] = stage
+        return {"stages": stages, "counters": dict(self.counters)}
+
+    def dump(self, path):
+        """ Writes the summary to path as JSON """
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=1, sort_keys=True)
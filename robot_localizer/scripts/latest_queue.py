@@ -0,0 +1,45 @@
+""" A thread-safe, single slot "latest wins" queue used to hand scans from the
+    ROS callback thread to the filter worker thread """
+
+import threading
+
+
+class LatestOnlyQueue(object):
+    """ Holds at most one pending item.  Putting a new item replaces (drops)
+        an item that has not been taken yet, so the consumer always works on
+        the most recent data.
+        Attributes:
+            dropped: the number of items that were superseded before being
+            taken
+            received: the total number of items put on the queue
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._item = None
+        self._pending = False
+        self.dropped = 0
+        self.received = 0
+
+    def put(self, item):
+        """ Makes item the pending item, dropping the previous pending item """
+        with self._condition:
+            if self._pending:
+                self.dropped += 1
+            self._item = item
+            self._pending = True
+            self.received += 1
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """ Takes the pending item, waiting up to timeout seconds (forever if
+            timeout is None) for one to arrive.  Returns None on timeout """
+        with self._condition:
+            if not self._pending:
+                self._condition.wait(timeout)
+            if not self._pending:
+                return None
+            item = self._item
+            self._item = None
+            self._pending = False
+            return item
@@ -0,0 +1,86 @@
+""" Loads map_server style maps (a .yaml description plus a .pgm/.ppm image)
+    straight from disk so that maps can be used without a running
+    map_server or a ROS install. """
+
+import os
+
+import numpy as np
+import yaml
+
+
+def read_pnm(path):
+    """ Reads a binary (P5/P6) or plain (P2/P3) PGM/PPM image into a numpy
+        array of shape (height, width) for grey images or (height, width, 3)
+        for color images.  The pixel data is read with a single bulk read. """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    # the header is the magic number, width, height and maxval separated by
+    # whitespace with optional comments running to the end of a line
+    tokens = []
+    pos = 0
+    while len(tokens) < 4:
+        while data[pos:pos + 1].isspace():
+            pos += 1
+        if data[pos:pos + 1] == b"#":
+            pos = data.index(b"\n", pos)
+            continue
+        start = pos
+        while not data[pos:pos + 1].isspace():
+            pos += 1
+        tokens.append(data[start:pos])
+    # exactly one whitespace character separates the header from the pixels
+    pos += 1
+
+    magic = tokens[0].decode()
+    width, height, maxval = (int(token) for token in tokens[1:])
+    if magic not in ("P2", "P3", "P5", "P6"):
+        raise ValueError("%s is not a PGM or PPM image" % path)
+    channels = 3 if magic in ("P3", "P6") else 1
+    count = width*height*channels
+
+    if magic in ("P5", "P6"):
+        dtype = np.dtype(">u2") if maxval > 255 else np.dtype(np.uint8)
+        pixels = np.frombuffer(data, dtype=dtype, count=count, offset=pos)
+    else:
+        pixels = np.array(data[pos:].split()[:count], dtype=np.uint16)
+    shape = (height, width, 3) if channels == 3 else (height, width)
+    return pixels.reshape(shape), maxval
+
+
+def occupancy_from_image(image, maxval, occupied_thresh, free_thresh,
+                         negate=False):
+    """ Converts a map image to occupancy values the same way map_server
+        does in trinary mode: 100 for occupied cells, 0 for free cells and
+        -1 for unknown cells.  Color images are averaged over their channels.
+        The returned [row, col] grid has row 0 at the bottom of the map
+        (the image is stored top row first). """
+    if image.ndim == 3:
+        image = image.mean(axis=2)
+    occupancy = image.astype(np.float64)/maxval
+    if not negate:
+        occupancy = 1.0 - occupancy
+    grid = np.full(occupancy.shape, -1, dtype=np.int8)
+    grid[occupancy > occupied_thresh] = 100
+    grid[occupancy < free_thresh] = 0
+    return np.flipud(grid)
+
+
+def load_map(yaml_path):
+    """ Loads the map described by a map_server yaml file.
+        Returns a tuple (grid, resolution, origin) where grid is an int8
+        [row, col] array of occupancy values and origin is the (x, y, yaw)
+        of the bottom left corner of the map. """
+    with open(yaml_path) as f:
+        description = yaml.safe_load(f)
+    image_path = description["image"]
+    if not os.path.isabs(image_path):
+        image_path = os.path.join(os.path.dirname(os.path.abspath(yaml_path)),
+                                  image_path)
+    image, maxval = read_pnm(image_path)
+    grid = occupancy_from_image(image, maxval,
+                                float(description["occupied_thresh"]),
+                                float(description["free_thresh"]),
+                                bool(int(description.get("negate", 0))))
+    origin = tuple(float(v) for v in description["origin"])
+    return grid, float(description["resolution"]), origin
@@ -0,0 +1,75 @@
+""" The odometry motion model used to propagate the particles between scans """
+
+import numpy as np
+
+from se2 import angle_normalize
+
+
+class OdometryMotionModel(object):
+    """ Samples the rotate-translate-rotate odometry motion model
+        (Probabilistic Robotics, table 5.6) for a whole particle cloud at once.
+        Attributes:
+            alphas: the (alpha1, alpha2, alpha3, alpha4) noise parameters.
+                alpha1: rotation noise from rotation
+                alpha2: rotation noise from translation
+                alpha3: translation noise from translation
+                alpha4: translation noise from rotation
+            rng: the numpy random Generator the noise is drawn from
+            min_translation: below this translation (meters) the direction
+                of the translation is dominated by noise, so it only adds to
+                the rotation noise through the net change of heading
+    """
+
+    def __init__(self, alphas=(0.2, 0.2, 0.2, 0.2), rng=None,
+                 min_translation=0.01):
+        self.alphas = tuple(alphas)
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.min_translation = min_translation
+
+    def decompose(self, odom_before, odom_after):
+        """ Splits the odometry motion between two (x, y, theta) poses into
+            (rot1, trans, rot2) """
+        dx = odom_after[0] - odom_before[0]
+        dy = odom_after[1] - odom_before[1]
+        trans = np.hypot(dx, dy)
+        # keep the direction even for tiny translations (e.g. creeping
+        # backwards); only the noise they add is damped in sample
+        rot1 = angle_normalize(np.arctan2(dy, dx) - odom_before[2]) \
+            if trans > 0 else 0.0
+        rot2 = angle_normalize(odom_after[2] - odom_before[2] - rot1)
+        return rot1, trans, rot2
+
+    def sample(self, poses, odom_before, odom_after):
+        """ Moves every particle by a noisy copy of the odometry motion from
+            odom_before to odom_after.
+            poses: an N x 3 array of (x, y, theta), updated in place
+            Returns poses """
+        if len(poses) == 0:
+            return poses
+        rot1, trans, rot2 = self.decompose(odom_before, odom_after)
+        a1, a2, a3, a4 = self.alphas
+
+        # driving backwards shows up as a rot1 of about pi; the noise should
+        # scale with the smaller equivalent rotation
+        rot1_noise = min(abs(rot1), abs(angle_normalize(rot1 - np.pi)))
+        rot2_noise = min(abs(rot2), abs(angle_normalize(rot2 - np.pi)))
+        if trans < self.min_translation:
+            # a tiny sideways step would otherwise add noise as if the robot
+            # turned by +-pi/2 twice; only the net turn is real rotation
+            rot1_noise = 0.0
+            rot2_noise = abs(angle_normalize(rot1 + rot2))
+        std = np.sqrt([a1*rot1_noise**2 + a2*trans**2,
+                       a3*trans**2 + a4*(rot1_noise**2 + rot2_noise**2),
+                       a1*rot2_noise**2 + a2*trans**2])
+
+        # draw the noise for every particle in one call
+        noise = self.rng.standard_normal((3, len(poses)))*std[:, np.newaxis]
+        rot1_hat = rot1 - noise[0]
+        trans_hat = trans - noise[1]
+        rot2_hat = rot2 - noise[2]
+
+        heading = poses[:, 2] + rot1_hat
+        poses[:, 0] += trans_hat*np.cos(heading)
+        poses[:, 1] += trans_hat*np.sin(heading)
+        poses[:, 2] = angle_normalize(heading + rot2_hat)
+        return poses
@@ -1,87 +1,374 @@
 """ An implementation of an occupancy field that you can use to implement
     your particle filter """
 
-import rospy
+import math
+import threading
 
-from nav_msgs.srv import GetMap
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
-import helper
+from scipy.ndimage import distance_transform_edt, minimum_filter
+from field_cache import FieldCache, field_key
+import map_loader
+
+try:
+    import rospy
+    from nav_msgs.srv import GetMap
+except ImportError:
+    # OccupancyField.from_yaml works without a ROS install
+    rospy = None
 
 
 class OccupancyField(object):
     """ Stores an occupancy field for an input map.  An occupancy field returns
         the distance to the closest obstacle for any coordinate in the map
         Attributes:
-            map: the map to localize against (nav_msgs/OccupancyGrid)
-            closest_occ: the distance for each entry in the OccupancyGrid to
-            the closest obstacle
+            map: the map to localize against (nav_msgs/OccupancyGrid).  None
+            when the map was loaded from disk with from_yaml
+            grid: the occupancy values of the map as an int8 array indexed by
+            [row, col] (row 0 is the bottom of the map)
+            resolution: the size of a map cell (meters)
+            origin: the (x, y) position of the bottom left corner of the map
+            width, height: the size of the map in cells
+            closest_occ: a float32 array indexed by [row, col] holding the
+            distance (in meters) from each cell of the OccupancyGrid to the
+            closest obstacle
+            field_path: the file closest_occ is memory mapped from when the
+            field is shared between processes (None otherwise)
+            cache: the FieldCache the field was loaded from (False if none)
+
+        pyramid returns coarser versions of the field for scoring many
+        hypotheses cheaply (see global_localization.py).
+
+        update_cells and update_region patch the map while the filter is
+        running.  They only recompute the distance field around the edited
+        cells and then swap the new grid and field in, so readers always see
+        either the old or the new field and never a partly updated one.
     """
 
-    def __init__(self):
+    # number of (particle, beam) pairs scored at once by score_particles.
+    # bounds the size of the temporary arrays for large particle clouds
+    SCORE_CHUNK_SIZE = 1 << 18
+
+    def __init__(self, cache=None, shared=False):
+        """ Construct the occupancy field for the map served by static_map.
+            cache: the FieldCache used to reuse distance fields computed on
+            previous runs.  Defaults to a FieldCache in the default cache
+            directory; pass False to always recompute the field.
+            shared: if True the field is a read-only memory map of the cache
+            file instead of a private copy, so every localizer process on
+            the machine that uses the same map and cache shares the same
+            physical pages.  Use a cache directory on a tmpfs (such as
+            field_cache.SHARED_CACHE_DIR) to keep the field in shared memory
+            without touching the disk. """
         # grab the map from the map server
         rospy.wait_for_service("static_map")
         static_map = rospy.ServiceProxy("static_map", GetMap)
         self.map = static_map().map
 
-        # The coordinates of each grid cell in the map
-        X = np.zeros((self.map.info.width*self.map.info.height, 2))
-
-        # while we're at it let's count the number of occupied cells
-        total_occupied = 0
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                # occupancy grids are stored in row major order
-                ind = i + j*self.map.info.width
-                if self.map.data[ind] > 0:
-                    total_occupied += 1
-                X[curr, 0] = float(i)
-                X[curr, 1] = float(j)
-                curr += 1
-
-        # The coordinates of each occupied grid cell in the map
-        occupied = np.zeros((total_occupied, 2))
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                # occupancy grids are stored in row major order
-                ind = i + j*self.map.info.width
-                if self.map.data[ind] > 0:
-                    occupied[curr, 0] = float(i)
-                    occupied[curr, 1] = float(j)
-                    curr += 1
-
-        # use super fast scikit learn nearest neighbor algorithm
-        nbrs = NearestNeighbors(n_neighbors=1,
-                                algorithm="ball_tree").fit(occupied)
-        distances, indices = nbrs.kneighbors(X)
-
-        self.closest_occ = {}
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                ind = i + j*self.map.info.width
-                self.closest_occ[ind] = \
-                    distances[curr][0]*self.map.info.resolution
-                curr += 1
+        # occupancy grids are stored in row major order
+        grid = np.asarray(self.map.data, dtype=np.int8).reshape(
+            (self.map.info.height, self.map.info.width))
+        self._set_map(grid, self.map.info.resolution,
+                      (self.map.info.origin.position.x,
+                       self.map.info.origin.position.y),
+                      cache, shared)
+
+    @classmethod
+    def from_yaml(cls, yaml_path, cache=None, shared=False):
+        """ Construct the occupancy field for a map_server style map file
+            (e.g. maps/ac109_1.yaml) without going through the static_map
+            service.  cache and shared are the same as for the regular
+            constructor. """
+        field = cls.__new__(cls)
+        field.map = None
+        grid, resolution, origin = map_loader.load_map(yaml_path)
+        field._set_map(grid, resolution, origin[:2], cache, shared)
+        return field
+
+    @classmethod
+    def attach(cls, field_path, resolution, origin):
+        """ Construct an occupancy field that memory maps the distance field
+            another OccupancyField shares through field_path (see the shared
+            argument of the constructor).  Only the distance lookups and
+            scoring are available; the occupancy grid itself is not loaded. """
+        field = cls.__new__(cls)
+        field.map = None
+        field.grid = None
+        field.resolution = resolution
+        field.origin = (float(origin[0]), float(origin[1]))
+        field.closest_occ = np.load(field_path, mmap_mode="r")
+        field.field_path = field_path
+        field.height, field.width = field.closest_occ.shape
+        return field
+
+    def _set_map(self, grid, resolution, origin, cache, shared):
+        """ Stores the map metadata and loads or computes its distance
+            field """
+        self.grid = grid
+        self.resolution = resolution
+        self.origin = (float(origin[0]), float(origin[1]))
+        self.height, self.width = grid.shape
+        if cache is None:
+            cache = FieldCache()
+        self.cache = cache
+        self._update_lock = threading.Lock()
+        self._pyramid = None
+        self.closest_occ, self.field_path = self.load_distance_field(
+            grid, resolution, self.origin, cache, shared)
+
+    @classmethod
+    def load_distance_field(cls, grid, resolution, origin, cache=False,
+                            shared=False):
+        """ Returns the distance field of grid, reading it from cache (a
+            FieldCache) if it was computed before and otherwise computing it
+            and storing it in the cache.  If shared is True the field is
+            returned as a read-only memory map of the cache file.
+
+            Returns a tuple (field, path) where path is the cache file the
+            field is mapped from, or None if the field is a private array """
+        if not cache:
+            return cls.compute_distance_field(grid, resolution), None
+        key = field_key(grid, resolution, origin)
+        mmap_mode = "r" if shared else None
+        distances = cache.load(key, mmap_mode=mmap_mode)
+        if distances is None or distances.shape != grid.shape:
+            distances = cls.compute_distance_field(grid, resolution)
+            if cache.store(key, distances) is None or not shared:
+                return distances, None
+            # re-open the freshly written file so that this process maps the
+            # same pages as every other process using the field
+            distances = cache.load(key, mmap_mode=mmap_mode)
+            if distances is None:
+                return cls.compute_distance_field(grid, resolution), None
+        return distances, (cache.path(key) if shared else None)
+
+    @staticmethod
+    def compute_distance_field(grid, resolution):
+        """ Computes the exact Euclidean distance (in meters) from every cell
+            of the occupancy grid (a [row, col] array of occupancy values) to
+            the closest occupied cell.  If the map has no occupied cells every
+            distance is infinite. """
+        occupied = grid > 0
+        if not occupied.any():
+            return np.full(grid.shape, np.inf, dtype=np.float32)
+        distances = distance_transform_edt(~occupied, sampling=resolution)
+        return distances.astype(np.float32)
+
+    def update_cells(self, rows, cols, values, max_distance=2.0):
+        """ Sets the occupancy values of the cells (rows[i], cols[i]) of the
+            map to values (e.g. 100 for a new obstacle, 0 for a removed one)
+            and updates the distance field around them.  See update_region
+            for max_distance. """
+        rows = np.asarray(rows, dtype=np.intp).ravel()
+        cols = np.asarray(cols, dtype=np.intp).ravel()
+        if len(rows) == 0:
+            return
+        if rows.min() < 0 or rows.max() >= self.height or \
+                cols.min() < 0 or cols.max() >= self.width:
+            raise ValueError("cells outside of the %d x %d map"
+                             % (self.height, self.width))
+        with self._update_lock:
+            grid = self.grid.copy()
+            grid[rows, cols] = values
+            self._update_distances(grid, rows.min(), rows.max() + 1,
+                                   cols.min(), cols.max() + 1, max_distance)
+
+    def update_region(self, row, col, patch, max_distance=2.0):
+        """ Replaces the occupancy values of the box of cells whose bottom
+            left cell is (row, col) by the [row, col] array patch and updates
+            the distance field around it.
+
+            Only the cells within max_distance of the box are recomputed, so
+            max_distance should be at least the max_distance the field is
+            scored with (the filter's laser_max_distance).  Distances up to
+            max_distance are exact; larger distances in the recomputed cells
+            are stored as max_distance, which the sensor models treat the
+            same way. """
+        patch = np.asarray(patch, dtype=np.int8)
+        patch = patch.reshape(patch.shape[-2:]) if patch.ndim > 1 \
+            else patch.reshape((1, -1))
+        height, width = patch.shape
+        if row < 0 or col < 0 or row + height > self.height or \
+                col + width > self.width:
+            raise ValueError("a %d x %d region at (%d, %d) does not fit in "
+                             "the %d x %d map" % (height, width, row, col,
+                                                  self.height, self.width))
+        with self._update_lock:
+            grid = self.grid.copy()
+            grid[row:row + height, col:col + width] = patch
+            self._update_distances(grid, row, row + height, col, col + width,
+                                   max_distance)
+
+    def _update_distances(self, grid, row_min, row_max, col_min, col_max,
+                          max_distance):
+        """ Recomputes the distance field of grid (the edited copy of
+            self.grid) for the cells within max_distance of the edited box
+            of rows [row_min, row_max) and columns [col_min, col_max), then
+            swaps grid and the new field in """
+        margin = int(math.ceil(max_distance/self.resolution)) + 1
+        # the cells whose distance can change by up to max_distance ...
+        r0, r1 = max(row_min - margin, 0), min(row_max + margin, self.height)
+        c0, c1 = max(col_min - margin, 0), min(col_max + margin, self.width)
+        # ... and every obstacle that can be within max_distance of them
+        outer_r0, outer_r1 = max(r0 - margin, 0), min(r1 + margin, self.height)
+        outer_c0, outer_c1 = max(c0 - margin, 0), min(c1 + margin, self.width)
+        window = self.compute_distance_field(grid[outer_r0:outer_r1,
+                                                  outer_c0:outer_c1],
+                                             self.resolution)
+
+        closest_occ = np.array(self.closest_occ, dtype=np.float32)
+        closest_occ[r0:r1, c0:c1] = np.minimum(
+            window[r0 - outer_r0:r1 - outer_r0, c0 - outer_c0:c1 - outer_c0],
+            max_distance)
+
+        field_path = None
+        if self.field_path is not None:
+            # other processes map the field from the cache, so publish the
+            # new field there as well
+            key = field_key(grid, self.resolution, self.origin,
+                            kind="distance-patched-%g" % max_distance)
+            if self.cache.store(key, closest_occ) is not None:
+                shared = self.cache.load(key, mmap_mode="r")
+                if shared is not None:
+                    closest_occ, field_path = shared, self.cache.path(key)
+        # swap in the new map and field
+        self.grid = grid
+        self.closest_occ = closest_occ
+        self.field_path = field_path
+        self._pyramid = None
+
+    def pyramid(self, factors=(1, 4, 16)):
+        """ Returns a resolution pyramid of the field: one level per factor,
+            finest first, with cells factor times the size of the map cells
+            (2 cm / 8 cm / 32 cm for the AC109 maps).  Each level is an
+            OccupancyField without a grid that can score particles like this
+            one.  A coarse cell holds the smallest distance within its own and
+            its eight neighbouring blocks of map cells, so a coarse level
+            never scores a pose near the true one worse than the full
+            resolution field does.  Each level also has a boolean [row, col]
+            array free marking the cells that contain free space.  The
+            pyramid is built on first use and rebuilt after map updates. """
+        pyramid = self._pyramid
+        if pyramid is None or [level.factor for level in pyramid] != list(factors):
+            pyramid = [self._pyramid_level(factor) for factor in factors]
+            self._pyramid = pyramid
+        return pyramid
+
+    def _pyramid_level(self, factor):
+        """ Builds the level of the pyramid with cells factor x factor map
+            cells in size """
+        level = OccupancyField.__new__(OccupancyField)
+        level.map = None
+        level.grid = None
+        level.field_path = None
+        level.factor = factor
+        level.resolution = self.resolution*factor
+        level.origin = self.origin
+        if factor == 1:
+            level.closest_occ = self.closest_occ
+            level.free = self.grid == 0
+        else:
+            height = -(-self.height // factor)*factor
+            width = -(-self.width // factor)*factor
+            blocks = np.full((height, width), np.inf, dtype=np.float32)
+            blocks[:self.height, :self.width] = self.closest_occ
+            blocks = blocks.reshape((height//factor, factor, width//factor, factor))
+            level.closest_occ = minimum_filter(blocks.min(axis=(1, 3)), size=3,
+                                               mode="nearest")
+            free = np.zeros((height, width), dtype=bool)
+            free[:self.height, :self.width] = self.grid == 0
+            level.free = free.reshape(blocks.shape).any(axis=(1, 3))
+        level.height, level.width = level.closest_occ.shape
+        return level
+
+    def _cell_indices(self, x, y):
+        """ Converts arrays of map coordinates to the (row, col) indices of
+            the cells containing them along with a mask of which coordinates
+            are inside the map """
+        col = np.floor((np.asarray(x) - self.origin[0]) /
+                       self.resolution).astype(np.intp)
+        row = np.floor((np.asarray(y) - self.origin[1]) /
+                       self.resolution).astype(np.intp)
+        in_map = (col >= 0) & (col < self.width) & \
+            (row >= 0) & (row < self.height)
+        return row, col, in_map
 
     def get_closest_obstacle_distance(self, x, y):
         """ Compute the closest obstacle to the specified (x,y) coordinate in
             the map.  If the (x,y) coordinate is out of the map boundaries, nan
             will be returned. """
-        x_coord = \
-            int((x - self.map.info.origin.position.x)/self.map.info.resolution)
-        y_coord = \
-            int((y - self.map.info.origin.position.y)/self.map.info.resolution)
+        x_coord = int(math.floor((x - self.origin[0])/self.resolution))
+        y_coord = int(math.floor((y - self.origin[1])/self.resolution))
 
         # check if we are in bounds
-        if x_coord > self.map.info.width or x_coord < 0:
+        if x_coord >= self.width or x_coord < 0:
             return float('nan')
-        if y_coord > self.map.info.height or y_coord < 0:
+        if y_coord >= self.height or y_coord < 0:
             return float('nan')
+        return float(self.closest_occ[y_coord, x_coord])
 
-        ind = x_coord + y_coord*self.map.info.width
-        if ind >= self.map.info.width*self.map.info.height or ind < 0:
-            return float('nan')
-        return self.closest_occ[ind]
+    def get_closest_obstacle_distances(self, x, y):
+        """ Batched version of get_closest_obstacle_distance.  x and y are
+            arrays of map coordinates (of the same shape).  Coordinates
+            outside of the map get nan. """
+        row, col, in_map = self._cell_indices(x, y)
+        distances = np.full(row.shape, np.nan, dtype=np.float32)
+        distances[in_map] = self.closest_occ[row[in_map], col[in_map]]
+        return distances
+
+    def score_particles(self, poses, scan_xy, sigma=0.1, max_distance=2.0,
+                        z_hit=0.95, z_rand=0.05):
+        """ Scores every particle against a scan.  Takes the same arguments as
+            log_likelihoods.  Returns an array of N weights, scaled so that
+            the most likely particle has weight 1 (the product of many
+            per-beam likelihoods would otherwise underflow). """
+        log_likelihood = self.log_likelihoods(poses, scan_xy, sigma=sigma,
+                                              max_distance=max_distance,
+                                              z_hit=z_hit, z_rand=z_rand)
+        if len(log_likelihood) == 0:
+            return np.ones(0)
+        return np.exp(log_likelihood - np.max(log_likelihood))
+
+    def log_likelihoods(self, poses, scan_xy, sigma=0.1, max_distance=2.0,
+                        z_hit=0.95, z_rand=0.05):
+        """ Computes the log likelihood of a scan for every particle with a
+            Gaussian likelihood field model.
+
+            poses: an N x 3 array of particle poses (x, y, theta) in the map
+            frame
+            scan_xy: an M x 2 array of scan points in the robot's base frame
+            sigma: the standard deviation of the range noise (in meters)
+            max_distance: the largest obstacle distance that is penalized.
+            Points that land outside the map get this distance.
+            z_hit, z_rand: the mixture weights of the Gaussian and uniform
+            components of the per-beam likelihood
+
+            Returns an array of the N log likelihoods of the scan. """
+        poses = np.asarray(poses, dtype=np.float64).reshape((-1, 3))
+        scan_xy = np.asarray(scan_xy, dtype=np.float64).reshape((-1, 2))
+        n, m = poses.shape[0], scan_xy.shape[0]
+        if n == 0 or m == 0:
+            return np.zeros(n)
+
+        # score the whole cloud against one field even if it is updated
+        # while this runs
+        closest_occ = self.closest_occ
+        log_likelihood = np.empty(n)
+        chunk = max(1, self.SCORE_CHUNK_SIZE // m)
+        for start in range(0, n, chunk):
+            x, y, theta = poses[start:start + chunk].T[:, :, np.newaxis]
+            cos_t, sin_t = np.cos(theta), np.sin(theta)
+            # rotate and translate every beam into the map frame of every particle
+            map_x = scan_xy[:, 0]*cos_t - scan_xy[:, 1]*sin_t + x
+            map_y = scan_xy[:, 0]*sin_t + scan_xy[:, 1]*cos_t + y
+
+            row, col, in_map = self._cell_indices(map_x, map_y)
+            distances = np.full(row.shape, max_distance)
+            distances[in_map] = closest_occ[row[in_map], col[in_map]]
+            np.minimum(distances, max_distance, out=distances)
+
+            beam_likelihood = z_hit*np.exp(-0.5*(distances/sigma)**2) + \
+                z_rand/max_distance
+            log_likelihood[start:start + chunk] = \
+                np.sum(np.log(beam_likelihood), axis=1)
+
+        return log_likelihood
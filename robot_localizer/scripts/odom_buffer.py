@@ -0,0 +1,91 @@
+""" A short history of odometry poses, so that the filter can look up where
+    the odometry put the robot at the time of a scan without waiting on tf.
+    The poses are appended by the odometry subscriber and interpolated by
+    the filter worker thread. """
+
+import threading
+
+import numpy as np
+
+from se2 import angle_normalize
+
+
+class OdomBuffer(object):
+    """ A ring buffer of the most recent odometry poses
+        Attributes:
+            stamps: a ring buffer of the times (seconds) of the poses
+            poses: a ring buffer of the (x, y, theta) odometry poses
+            count: the total number of poses ever added
+            tolerance: how far (seconds) outside of the buffered times a
+            lookup is still answered, with the oldest or newest pose
+    """
+
+    def __init__(self, size=500, tolerance=0.05):
+        self.stamps = np.zeros(size)
+        self.poses = np.zeros((size, 3))
+        self.count = 0
+        self.tolerance = tolerance
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, len(self.stamps))
+
+    def clear(self):
+        with self._lock:
+            self.count = 0
+
+    def add(self, stamp, xy_theta):
+        """ Appends the odometry pose xy_theta at time stamp (seconds).  Poses
+            older than the newest one are dropped, unless time jumped back by
+            more than tolerance (e.g. a restarted simulation or a looping bag
+            file), which clears the buffer """
+        with self._lock:
+            if self.count:
+                newest = self.stamps[(self.count - 1) % len(self.stamps)]
+                if stamp < newest - self.tolerance:
+                    self.count = 0
+                elif stamp <= newest:
+                    return
+            i = self.count % len(self.stamps)
+            self.stamps[i] = stamp
+            self.poses[i] = xy_theta
+            self.count += 1
+
+    def _ordered(self):
+        """ The buffered stamps and poses, oldest first """
+        n = len(self)
+        start = self.count - n
+        order = np.arange(start, start + n) % len(self.stamps)
+        return self.stamps[order], self.poses[order]
+
+    def latest(self):
+        """ The newest (stamp, (x, y, theta)), or None if the buffer is empty """
+        with self._lock:
+            if not(self.count):
+                return None
+            i = (self.count - 1) % len(self.stamps)
+            return self.stamps[i], self.poses[i].copy()
+
+    def at(self, stamp):
+        """ Returns the (x, y, theta) odometry pose at time stamp (seconds),
+            linearly interpolated between the buffered poses on either side
+            (the heading along the shorter way around), or None if stamp is
+            further than tolerance from the buffered times """
+        with self._lock:
+            if not(self.count):
+                return None
+            stamps, poses = self._ordered()
+        if stamp < stamps[0] - self.tolerance or \
+                stamp > stamps[-1] + self.tolerance:
+            return None
+        i = np.searchsorted(stamps, stamp)
+        if i == 0:
+            return poses[0].copy()
+        if i == len(stamps):
+            return poses[-1].copy()
+        before, after = poses[i - 1], poses[i]
+        fraction = (stamp - stamps[i - 1])/(stamps[i] - stamps[i - 1])
+        pose = before + fraction*(after - before)
+        pose[2] = angle_normalize(before[2] + fraction *
+                                  angle_normalize(after[2] - before[2]))
+        return pose
@@ -0,0 +1,151 @@
+""" Parallel particle weighting.  The particle cloud is split into shards
+    that a pool of worker processes score against the scan.  The workers
+    memory map the shared occupancy field and exchange the particle poses,
+    the scan and the resulting log likelihoods through memory mapped buffer
+    files, so neither the field nor the particle arrays are ever pickled. """
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from occupancy_field import OccupancyField
+
+# state of a worker process, set up by _init_worker
+_worker_field = None
+_worker_buffers = {}
+
+
+def _init_worker(field_path, resolution, origin):
+    global _worker_field
+    _worker_field = OccupancyField.attach(field_path, resolution, origin)
+
+
+def _worker_buffer(path, shape):
+    """ Returns the worker's memory map of a shared buffer file, opening it
+        the first time it is used """
+    buffer = _worker_buffers.get(path)
+    if buffer is None:
+        buffer = np.memmap(path, dtype=np.float64, mode="r+", shape=shape)
+        _worker_buffers[path] = buffer
+    return buffer
+
+
+def _score_shard(task):
+    """ Scores the particles in rows [start, stop) of the shared pose buffer
+        and writes their log likelihoods to the shared output buffer """
+    field_path, buffers, capacity, scan_capacity, m, start, stop, kwargs = task
+    if field_path != _worker_field.field_path:
+        # the parent updated its map
+        _init_worker(field_path, _worker_field.resolution, _worker_field.origin)
+    # let go of buffers the parent has replaced
+    for path in list(_worker_buffers):
+        if path not in buffers:
+            del _worker_buffers[path]
+    poses = _worker_buffer(buffers[0], (capacity, 3))
+    scan_xy = _worker_buffer(buffers[1], (scan_capacity, 2))
+    out = _worker_buffer(buffers[2], (capacity,))
+    out[start:stop] = _worker_field.log_likelihoods(poses[start:stop],
+                                                    scan_xy[:m], **kwargs)
+    return stop - start
+
+
+class ParallelScorer(object):
+    """ Scores particles with a pool of worker processes.  Produces exactly
+        the same weights as field.score_particles.
+        Attributes:
+            field: the OccupancyField to score against.  It must be shared
+            (have a field_path) so that the workers can map it.  When the
+            field is updated the workers map the new field_path
+            n_workers: the number of worker processes
+            min_particles: clouds smaller than this are scored in this process
+    """
+
+    def __init__(self, field, n_workers=None, min_particles=2000):
+        if field.field_path is None:
+            raise ValueError("parallel weighting needs an OccupancyField "
+                             "constructed with shared=True")
+        self.field = field
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self.min_particles = min_particles
+        # keep the buffers in memory when a tmpfs is available
+        self.buffer_dir = tempfile.mkdtemp(
+            prefix="pf_weights_",
+            dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        self.capacity = 0
+        self.scan_capacity = 0
+        self.buffer_index = 0
+        self.pose_path = self.out_path = self.scan_path = None
+        # the workers map the field by path, so they do not need to be forked.
+        # Forking a process that already runs threads (rospy, tf) can leave
+        # the children holding locks that no thread will ever release
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+        else:
+            context = multiprocessing.get_context("spawn")
+        self.pool = context.Pool(
+            self.n_workers, initializer=_init_worker,
+            initargs=(field.field_path, field.resolution, field.origin))
+
+    def _buffer(self, name, shape):
+        """ Creates a new buffer file and returns its path and memory map.  A
+            fresh file is used every time a buffer grows so that workers never
+            see a file change size under their mapping """
+        self.buffer_index += 1
+        path = os.path.join(self.buffer_dir, "%s-%d" % (name, self.buffer_index))
+        return path, np.memmap(path, dtype=np.float64, mode="w+", shape=shape)
+
+    def _reserve(self, n, m):
+        """ Makes sure the shared buffers can hold n particles and m scan
+            points.  Old buffer files are removed; workers keep their mappings
+            of them until they move on to the new files """
+        if n > self.capacity:
+            for path in (self.pose_path, self.out_path):
+                if path is not None:
+                    os.unlink(path)
+            self.capacity = max(n, 2*self.capacity)
+            self.pose_path, self.poses = self._buffer("poses",
+                                                      (self.capacity, 3))
+            self.out_path, self.out = self._buffer("out", (self.capacity,))
+        if m > self.scan_capacity:
+            if self.scan_path is not None:
+                os.unlink(self.scan_path)
+            self.scan_capacity = max(m, 2*self.scan_capacity)
+            self.scan_path, self.scan = self._buffer("scan",
+                                                     (self.scan_capacity, 2))
+
+    def log_likelihoods(self, poses, scan_xy, **kwargs):
+        """ Parallel version of OccupancyField.log_likelihoods """
+        poses = np.asarray(poses, dtype=np.float64).reshape((-1, 3))
+        scan_xy = np.asarray(scan_xy, dtype=np.float64).reshape((-1, 2))
+        n, m = poses.shape[0], scan_xy.shape[0]
+        field_path = self.field.field_path
+        if n < self.min_particles or m == 0 or field_path is None:
+            return self.field.log_likelihoods(poses, scan_xy, **kwargs)
+
+        self._reserve(n, m)
+        self.poses[:n] = poses
+        self.scan[:m] = scan_xy
+        buffers = (self.pose_path, self.scan_path, self.out_path)
+        bounds = np.linspace(0, n, self.n_workers + 1).astype(np.intp)
+        tasks = [(field_path, buffers, self.capacity, self.scan_capacity, m,
+                  start, stop, kwargs)
+                 for start, stop in zip(bounds[:-1], bounds[1:])
+                 if stop > start]
+        self.pool.map(_score_shard, tasks)
+        return np.array(self.out[:n])
+
+    def score_particles(self, poses, scan_xy, **kwargs):
+        """ Parallel version of OccupancyField.score_particles """
+        log_likelihood = self.log_likelihoods(poses, scan_xy, **kwargs)
+        if len(log_likelihood) == 0:
+            return np.ones(0)
+        return np.exp(log_likelihood - np.max(log_likelihood))
+
+    def close(self):
+        """ Stops the worker processes and removes the shared buffers """
+        self.pool.terminate()
+        self.pool.join()
+        shutil.rmtree(self.buffer_dir, ignore_errors=True)
@@ -0,0 +1,260 @@
+""" A structure-of-arrays store for the particle filter's particle cloud.
+    All of the particle state lives in a single contiguous N x 4 float64
+    array so that the filter steps can run as vectorized numpy operations
+    instead of looping over Python objects. """
+
+import numpy as np
+
+# column layout of ParticleCloud.state
+X, Y, THETA, W = range(4)
+
+
+def _column_property(column, doc):
+    """ Builds a property that reads and writes one column of the backing
+        state row of a Particle """
+    def getter(self):
+        return float(self._state[self._index, column])
+
+    def setter(self, value):
+        self._state[self._index, column] = value
+
+    return property(getter, setter, doc=doc)
+
+
+class Particle(object):
+    """ Represents a hypothesis (particle) of the robot's pose consisting of x,y and theta (yaw)
+        A Particle is a thin view onto one row of a ParticleCloud, reading and
+        writing the cloud's arrays directly.  A Particle constructed on its own
+        gets a private single row of storage.
+        Attributes:
+            x: the x-coordinate of the hypothesis relative to the map frame
+            y: the y-coordinate of the hypothesis relative ot the map frame
+            theta: the yaw of the hypothesis relative to the map frame
+            w: the particle weight (the class does not ensure that particle weights are normalized
+    """
+    __slots__ = ('_state', '_index')
+
+    def __init__(self, x=0.0, y=0.0, theta=0.0, w=1.0):
+        """ Construct a new Particle
+            x: the x-coordinate of the hypothesis relative to the map frame
+            y: the y-coordinate of the hypothesis relative ot the map frame
+            theta: the yaw of the hypothesis relative to the map frame
+            w: the particle weight (the class does not ensure that particle weights are normalized """
+        self._state = np.array([[x, y, theta, w]], dtype=np.float64)
+        self._index = 0
+
+    @classmethod
+    def view(cls, state, index):
+        """ Returns a Particle backed by row index of the N x 4 array state """
+        particle = cls.__new__(cls)
+        particle._state = state
+        particle._index = index
+        return particle
+
+    x = _column_property(X, "the x-coordinate of the hypothesis")
+    y = _column_property(Y, "the y-coordinate of the hypothesis")
+    theta = _column_property(THETA, "the yaw of the hypothesis")
+    w = _column_property(W, "the weight of the hypothesis")
+
+    def as_pose(self):
+        """ A helper function to convert a particle to a geometry_msgs/Pose message """
+        from geometry_msgs.msg import Pose, Point, Quaternion
+        return Pose(position=Point(x=self.x, y=self.y, z=0),
+                    orientation=Quaternion(x=0.0, y=0.0,
+                                           z=np.sin(self.theta/2.0),
+                                           w=np.cos(self.theta/2.0)))
+
+
+class ParticleCloud(object):
+    """ Stores a set of particles as a structure of arrays
+        Attributes:
+            state: an N x 4 float64 array with columns x, y, theta and w
+    """
+
+    def __init__(self, n=0):
+        """ Construct a cloud of n particles at the origin with unit weight """
+        self.state = np.zeros((n, 4), dtype=np.float64)
+        self.state[:, W] = 1.0
+
+    @classmethod
+    def from_arrays(cls, x, y, theta, w=None):
+        """ Builds a cloud from equal length arrays of x, y, theta and
+            (optionally) w.  If w is omitted every particle gets unit weight """
+        cloud = cls(len(x))
+        cloud.state[:, X] = x
+        cloud.state[:, Y] = y
+        cloud.state[:, THETA] = theta
+        if w is not None:
+            cloud.state[:, W] = w
+        return cloud
+
+    @classmethod
+    def from_particles(cls, particles):
+        """ Builds a cloud from an iterable of Particle objects """
+        particles = list(particles)
+        cloud = cls(len(particles))
+        for i, p in enumerate(particles):
+            cloud.state[i] = (p.x, p.y, p.theta, p.w)
+        return cloud
+
+    @property
+    def x(self):
+        return self.state[:, X]
+
+    @property
+    def y(self):
+        return self.state[:, Y]
+
+    @property
+    def theta(self):
+        return self.state[:, THETA]
+
+    @property
+    def w(self):
+        return self.state[:, W]
+
+    @property
+    def poses(self):
+        """ An N x 3 view of the (x, y, theta) of every particle """
+        return self.state[:, :W]
+
+    def __len__(self):
+        return self.state.shape[0]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("particle index out of range")
+        return Particle.view(self.state, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield Particle.view(self.state, i)
+
+    def planar_pose_arrays(self, max_count=None):
+        """ Returns lists of the x, y and yaw quaternion z and w components of
+            the particles, ready to be copied into Pose messages.  If max_count
+            is given (and non-zero) an evenly strided subset of at most
+            max_count particles is returned """
+        poses = self.poses
+        if max_count and len(poses) > max_count:
+            poses = poses[::-(-len(poses)//max_count)]
+        half_theta = poses[:, THETA]/2.0
+        return (poses[:, X].tolist(), poses[:, Y].tolist(),
+                np.sin(half_theta).tolist(), np.cos(half_theta).tolist())
+
+    def normalize_weights(self):
+        """ Scales the weights so that they sum to one.  If the weights do not
+            have a positive finite sum they are reset to uniform """
+        if len(self) == 0:
+            return
+        total = np.sum(self.state[:, W])
+        if np.isfinite(total) and total > 0:
+            self.state[:, W] /= total
+        else:
+            self.state[:, W] = 1.0/len(self)
+
+    def effective_sample_size(self):
+        """ Returns the effective sample size 1/sum(w^2) of the (normalized)
+            weights.  It is len(self) for uniform weights and approaches 1 as
+            the weight concentrates on a single particle """
+        squared = np.dot(self.state[:, W], self.state[:, W])
+        if squared <= 0:
+            return 0.0
+        total = np.sum(self.state[:, W])
+        return float(total*total/squared)
+
+    def resample(self, indices):
+        """ Replaces the cloud with the particles at indices (gathered with a
+            single fancy-index copy) and resets the weights to uniform """
+        self.state = self.state[indices]
+        if len(self):
+            self.state[:, W] = 1.0/len(self)
+
+    def mean_pose(self, weights=None):
+        """ Returns the weighted mean (x, y, theta) of the cloud.  The heading
+            is the circular mean, so headings on either side of +-pi average
+            to about pi rather than 0.  weights defaults to the particle
+            weights and need not be normalized """
+        if weights is None:
+            weights = self.state[:, W]
+        total = np.sum(weights)
+        if len(self) == 0 or not(total > 0):
+            return np.zeros(3)
+        theta = self.state[:, THETA]
+        return np.array([np.dot(weights, self.state[:, X])/total,
+                         np.dot(weights, self.state[:, Y])/total,
+                         np.arctan2(np.dot(weights, np.sin(theta)),
+                                    np.dot(weights, np.cos(theta)))])
+
+    def covariance(self, mean=None, weights=None):
+        """ Returns the weighted 3 x 3 covariance of (x, y, theta) about mean
+            (by default the mean_pose).  Heading differences are wrapped to
+            [-pi, pi] """
+        if weights is None:
+            weights = self.state[:, W]
+        if mean is None:
+            mean = self.mean_pose(weights)
+        total = np.sum(weights)
+        if len(self) == 0 or not(total > 0):
+            return np.zeros((3, 3))
+        deviation = self.poses - mean
+        deviation[:, THETA] = np.arctan2(np.sin(deviation[:, THETA]),
+                                         np.cos(deviation[:, THETA]))
+        return np.dot(deviation.T*weights, deviation)/total
+
+    def cluster_weights(self, bin_size=(0.25, 0.25, np.pi/9)):
+        """ Returns the particle weights with every particle outside of the
+            heaviest cluster set to zero.  Particles are hashed into an
+            (x, y, theta) grid with cells of bin_size; the cluster is the cell
+            whose 3 x 3 x 3 neighbourhood holds the most weight, together
+            with that neighbourhood """
+        weights = self.state[:, W]
+        if len(self) == 0:
+            return weights.copy()
+        n_theta = int(np.ceil(2*np.pi/bin_size[2]))
+        bins = np.empty((len(self), 3), dtype=np.int64)
+        bins[:, 0] = np.floor(self.state[:, X]/bin_size[0])
+        bins[:, 1] = np.floor(self.state[:, Y]/bin_size[1])
+        bins[:, 2] = np.floor((self.state[:, THETA] + np.pi)/bin_size[2])
+        bins[:, 2] %= n_theta
+        # pack each cell into a single integer key, leaving a one cell border
+        # so that the neighbours of every cell have keys too
+        low = bins[:, :2].min(axis=0) - 1
+        span = bins[:, 1].max() - low[1] + 2
+
+        def pack(x, y, theta):
+            return ((x - low[0])*span + y - low[1])*n_theta + theta % n_theta
+
+        cells, inverse = np.unique(pack(bins[:, 0], bins[:, 1], bins[:, 2]),
+                                   return_inverse=True)
+        cell_weights = np.bincount(inverse.reshape(-1), weights=weights,
+                                   minlength=len(cells))
+        cell_x = cells//n_theta//span + low[0]
+        cell_y = cells//n_theta % span + low[1]
+        cell_theta = cells % n_theta
+        # score each occupied cell by the weight of the cluster around it, so
+        # a spread out cloud is not summarized by a single lucky particle
+        scores = np.zeros(len(cells))
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dtheta in {-1 % n_theta, 0, 1 % n_theta}:
+                    neighbours = pack(cell_x + dx, cell_y + dy,
+                                      cell_theta + dtheta)
+                    found = np.minimum(np.searchsorted(cells, neighbours),
+                                       len(cells) - 1)
+                    scores += np.where(cells[found] == neighbours,
+                                       cell_weights[found], 0.0)
+        heaviest = np.argmax(scores)
+        best = np.array([cell_x[heaviest], cell_y[heaviest],
+                         cell_theta[heaviest]])
+
+        offset = np.abs(bins - best)
+        offset[:, 2] = np.minimum(offset[:, 2], n_theta - offset[:, 2])
+        return np.where(np.all(offset <= 1, axis=1), weights, 0.0)
+
+    def mode_pose(self, bin_size=(0.25, 0.25, np.pi/9)):
+        """ Returns the weighted mean (x, y, theta) of the heaviest cluster of
+            particles (see cluster_weights) """
+        return self.mean_pose(self.cluster_weights(bin_size))
@@ -3,83 +3,78 @@
 """ This is the starter code for the robot localization project """
 
 import rospy
-import placeParticles as pp
 
-from std_msgs.msg import Header, String
+from std_msgs.msg import Header, String, Float32
 from sensor_msgs.msg import LaserScan, PointCloud
-from geometry_msgs.msg import PoseStamped, PoseWithCovarianceStamped, PoseArray, Pose, Point, Quaternion
-from nav_msgs.srv import GetMap
-from copy import deepcopy
+from geometry_msgs.msg import PoseWithCovarianceStamped, PoseWithCovariance, PoseArray, Pose, Point, Quaternion
+from nav_msgs.msg import Odometry
+from std_srvs.srv import Empty, EmptyResponse
+from map_msgs.msg import OccupancyGridUpdate
 
 import tf
 from tf import TransformListener
 from tf import TransformBroadcaster
-from tf.transformations import euler_from_quaternion, rotation_matrix, quaternion_from_matrix, quaternion_from_euler
-from random import gauss
+from tf.transformations import euler_from_quaternion, quaternion_from_euler
 
-import math
-import time
+import threading
+import traceback
 
 import numpy as np
-from numpy.random import random_sample
-from sklearn.neighbors import NearestNeighbors
-from occupancy_field import OccupancyField
 from helper_functions import TFHelper
 
 from occupancy_field import OccupancyField
-import helper
+from beam_model import BeamModel
+from parallel_weighting import ParallelScorer
+from field_cache import FieldCache, DEFAULT_CACHE_DIR
+from filter_core import FilterCore
+from motion_model import OdometryMotionModel
+from latest_queue import LatestOnlyQueue
+from scan_preprocessing import ScanPreprocessor
+from instrumentation import Instrumentation
+from odom_buffer import OdomBuffer
+from se2 import SE2
 
 from visualization_msgs.msg import Marker
 from visualization_msgs.msg import MarkerArray
-
-class Particle(object):
-    """ Represents a hypothesis (particle) of the robot's pose consisting of x,y and theta (yaw)
-        Attributes:
-            x: the x-coordinate of the hypothesis relative to the map frame
-            y: the y-coordinate of the hypothesis relative ot the map frame
-            theta: the yaw of the hypothesis relative to the map frame
-            w: the particle weight (the class does not ensure that particle weights are normalized
-    """
-
-    def __init__(self,x=0.0,y=0.0,theta=0.0,w=1.0):
-        """ Construct a new Particle
-            x: the x-coordinate of the hypothesis relative to the map frame
-            y: the y-coordinate of the hypothesis relative ot the map frame
-            theta: the yaw of the hypothesis relative to the map frame
-            w: the particle weight (the class does not ensure that particle weights are normalized """ 
-        self.w = w
-        self.theta = theta
-        self.x = x
-        self.y = y
-
-    def as_pose(self):
-        """ A helper function to convert a particle to a geometry_msgs/Pose message """
-        orientation_tuple = tf.transformations.quaternion_from_euler(0,0,self.theta)
-        return Pose(position=Point(x=self.x,y=self.y,z=0), orientation=Quaternion(x=orientation_tuple[0], y=orientation_tuple[1], z=orientation_tuple[2], w=orientation_tuple[3]))
-
-
-
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 
 class ParticleFilter:
     """ The class that represents a Particle Filter ROS Node
         Attributes list:
             initialized: a Boolean flag to communicate to other class methods that initializaiton is complete
+            initial_localization: how the cloud is started without an initial pose, "global" (localize
+                                  from the first scan anywhere in the map), "uniform" (over the free space
+                                  of the map) or "odom" (around the odometry pose)
+            global_localization_pending: set by the global_localization service to relocalize from the next scan
             base_frame: the name of the robot base coordinate frame (should be "base_link" for most robots)
             map_frame: the name of the map coordinate frame (should be "map" in most cases)
             odom_frame: the name of the odometry coordinate frame (should be "odom" in most cases)
             scan_topic: the name of the scan topic to listen to (should be "scan" in most cases)
-            n_particles: the number of particles in the filter
-            d_thresh: the amount of linear movement before triggering a filter update
-            a_thresh: the amount of angular movement before triggering a filter update
-            laser_max_distance: the maximum distance to an obstacle we should use in a likelihood calculation
+            core: the FilterCore that holds the particle cloud and runs the filter steps.  The filter's
+                  parameters (number of particles, motion and sensor model noise, resampling) live there
+            sensor_model: the model used to weight particles against a scan (the OccupancyField for the
+                          likelihood field model, a ParallelScorer wrapping it, or a BeamModel)
+            weighting_workers: the number of worker processes for weighting the particles (0 to weight serially)
             pose_listener: a subscriber that listens for new approximate pose estimates (i.e. generated through the rviz GUI)
             particle_pub: a publisher for the particle cloud
+            particle_publish_max: the largest number of particles to publish (0 publishes every particle)
+            pose_pub: a publisher for the pose estimate and its covariance
+            ess_pub: a publisher for the effective sample size of the particle weights
             laser_subscriber: listens for new scan data on topic self.scan_topic
+            scan_queue: hands the latest scan from the subscriber callback to the filter worker thread
+            filter_lock: held while the particle cloud is being updated
+            latency_pub: a publisher for the time from a scan's stamp to its map to odom update
+            latency_budget: the latency (seconds) above which a warning is logged
+            instrumentation: rolling timings of the filter stages and counts of skipped scans
+            diagnostics_pub: a publisher for a periodic summary of the instrumentation
+            odom_buffer: the recent odometry poses, interpolated to the time of each scan
+            odom_xy_theta: the odometry pose (x, y, theta) at the time of the latest scan
+            static_transforms: the SE2 transforms from the sensor frames to the base frame, looked up
+                               once per frame since the sensors are rigidly mounted
             tf_listener: listener for coordinate transforms
             tf_broadcaster: broadcaster for coordinate transforms
-            particle_cloud: a list of particles representing a probability distribution over robot poses
-            current_odom_xy_theta: the pose of the robot in the odometry frame when the last filter update was performed.
-                                   The pose is expressed as a list [x,y,theta] (where theta is the yaw)
+            transform_publish_rate: the rate (Hz) at which the map to odom transform is rebroadcast while
+                                    no new estimate comes in (each new estimate is broadcast immediately)
             map: the map we will be localizing ourselves in.  The map should be of type nav_msgs/OccupancyGrid
     """
     def __init__(self):
@@ -94,16 +89,82 @@ class ParticleFilter:
          # enable listening for and broadcasting coordinate transforms
         self.tf_listener = TransformListener()
         self.tf_broadcaster = TransformBroadcaster()
+        # created before any subscription, since the callbacks use it
+        self.transform_helper = TFHelper()
 
-        self.occupancy_field = OccupancyField()
-
-
-        self.n_particles = 400      # the number of particles to use
-
-        self.d_thresh = 0.002            # the amount of linear movement before performing an update
-        self.a_thresh = 0.00001#np.pi/6       # the amount of angular movement before performing an update
-
-        self.laser_max_distance = 2.0   # maximum penalty to assess in the likelihood field model
+        # share_field memory maps the occupancy field from the cache so that several localizers can use one copy
+        # weighting_workers > 0 scores large particle clouds on a pool of worker processes that map the shared field
+        self.weighting_workers = rospy.get_param("~weighting_workers", 0)
+        field_cache = FieldCache(rospy.get_param("~field_cache_dir", DEFAULT_CACHE_DIR))
+        self.occupancy_field = OccupancyField(cache=field_cache,
+                                              shared=rospy.get_param("~share_field", False) or self.weighting_workers > 0)
+
+        # the sensor model used to weight the particles: "likelihood_field" or "beam" (ray casting)
+        sensor_model = rospy.get_param("~sensor_model", "likelihood_field")
+        if sensor_model == "beam":
+            self.sensor_model = BeamModel(self.occupancy_field, max_range=rospy.get_param("~beam_max_range", 5.0), cache=field_cache)
+        elif sensor_model == "likelihood_field":
+            self.sensor_model = self.occupancy_field
+            if self.weighting_workers > 0:
+                if self.occupancy_field.field_path is None:
+                    rospy.logwarn("the occupancy field could not be shared; weighting particles serially")
+                else:
+                    self.sensor_model = ParallelScorer(self.occupancy_field, n_workers=self.weighting_workers)
+                    rospy.on_shutdown(self.sensor_model.close)
+        else:
+            raise ValueError("unknown sensor model %r" % sensor_model)
+
+
+        # KLD sampling adapts the number of particles to the spread of the cloud at each resample
+        kld_bin_size = (rospy.get_param("~kld_bin_xy", 0.25),   # histogram bin size in meters and radians
+                        rospy.get_param("~kld_bin_xy", 0.25),
+                        rospy.get_param("~kld_bin_theta", np.pi/18))
+
+        rng = np.random.default_rng(rospy.get_param("~seed", None))    # random number generator for the filter
+
+        # odometry motion model noise: rot from rot, rot from trans, trans from trans, trans from rot
+        motion_model = OdometryMotionModel(alphas=(rospy.get_param("~odom_alpha1", 0.2),
+                                                   rospy.get_param("~odom_alpha2", 0.2),
+                                                   rospy.get_param("~odom_alpha3", 0.2),
+                                                   rospy.get_param("~odom_alpha4", 0.2)),
+                                           rng=rng)
+
+        # drop invalid returns and downsample each scan before it is used for weighting
+        scan_preprocessor = ScanPreprocessor(min_range=rospy.get_param("~scan_min_range", 0.05),
+                                             max_range=rospy.get_param("~scan_max_range", 5.0),
+                                             strategy=rospy.get_param("~scan_downsample", "angular"),
+                                             stride=rospy.get_param("~scan_stride", 2),
+                                             angular_bin=np.radians(rospy.get_param("~scan_angular_bin_deg", 2.0)),
+                                             voxel_size=rospy.get_param("~scan_voxel_size", 0.1),
+                                             max_points=rospy.get_param("~scan_max_points", 120),
+                                             rng=rng)
+
+        # timings of the filter stages over the last timing_window scans
+        self.instrumentation = Instrumentation(window=rospy.get_param("~timing_window", 500))
+
+        # the filter itself; this node feeds it odometry and scans and publishes its results
+        self.core = FilterCore(self.sensor_model,
+                               instrumentation=self.instrumentation,
+                               n_particles=rospy.get_param("~n_particles", 400),   # the initial number with KLD sampling
+                               rng=rng,
+                               motion_model=motion_model,
+                               scan_preprocessor=scan_preprocessor,
+                               d_thresh=0.002,              # the amount of linear movement before performing an update
+                               a_thresh=0.00001,            # the amount of angular movement before performing an update
+                               sigma_hit=rospy.get_param("~sigma_hit", 0.1),    # standard deviation of the likelihood field model (meters)
+                               laser_max_distance=2.0,      # maximum penalty to assess in the likelihood field model
+                               resample_method=rospy.get_param("~resample_method", "systematic"),  # systematic, stratified, residual or multinomial
+                               resample_threshold=rospy.get_param("~resample_threshold", 0.5),  # resample when the ESS drops below this fraction of the cloud size
+                               kld_sampling=rospy.get_param("~kld_sampling", True),
+                               kld_min_particles=rospy.get_param("~kld_min_particles", 100),
+                               kld_max_particles=rospy.get_param("~kld_max_particles", 5000),
+                               kld_bin_size=kld_bin_size,
+                               kld_epsilon=rospy.get_param("~kld_epsilon", 0.05),   # bound on the KL divergence of the sample approximation
+                               kld_z=rospy.get_param("~kld_z", 2.326),              # upper standard normal quantile for the bound (0.99)
+                               pose_estimate=rospy.get_param("~pose_estimate", "mean"),  # "mean" or "mode" (heaviest cluster)
+                               mode_bin_size=(rospy.get_param("~mode_bin_xy", 0.25),    # cluster cell size in meters and radians
+                                              rospy.get_param("~mode_bin_xy", 0.25),
+                                              rospy.get_param("~mode_bin_theta", np.pi/9)))
 
         # TODO: define additional constants if needed
     
@@ -112,16 +173,53 @@ class ParticleFilter:
         # pose_listener responds to selection of a new approximate robot location (for instance using rviz)
         rospy.Subscriber("initialpose", PoseWithCovarianceStamped, self.update_initial_pose)
 
+        # without an initial pose the robot is localized globally from the first scan ("global"),
+        # the particles are spread uniformly over the free space of the map ("uniform"), or the
+        # cloud is started around the odometry pose ("odom").  The global_localization service
+        # relocalizes globally from the next scan
+        self.initial_localization = rospy.get_param("~initial_localization", "global")
+        self.global_localization_pending = False
+        rospy.Service("global_localization", Empty, self.request_global_localization)
+
+        # edits to regions of the map are patched into the occupancy field while the filter runs
+        rospy.Subscriber("map_updates", OccupancyGridUpdate, self.map_update_received)
+
         # publish the current particle cloud.  This enables viewing particles in rviz.
         self.particle_pub = rospy.Publisher("my_particle_cloud", PoseArray, queue_size=10)
 
+        self.particle_publish_max = rospy.get_param("~particle_publish_max", 0)  # publish at most this many particles (0 for all)
+        self.particle_poses = []    # Pose messages reused by publish_particles
+
+        # publish the pose estimate along with the covariance of the particles
+        self.pose_pub = rospy.Publisher("estimated_pose", PoseWithCovarianceStamped, queue_size=10)
+
+        # publish the effective sample size of the particle weights as a diagnostic
+        self.ess_pub = rospy.Publisher("effective_sample_size", Float32, queue_size=10)
+
         # publish visualization markers
         self.markerArrayPub = rospy.Publisher("markers", MarkerArray)
 
+        # publish the latency from each scan's stamp to the resulting map to odom transform
+        self.latency_pub = rospy.Publisher("filter_latency", Float32, queue_size=10)
+        self.latency_budget = rospy.get_param("~latency_budget", 0.2)   # seconds
+
+        # periodically publish the stage timings and skipped scan counts
+        self.diagnostics_pub = rospy.Publisher("/diagnostics", DiagnosticArray, queue_size=10)
+        rospy.Timer(rospy.Duration(rospy.get_param("~diagnostics_period", 1.0)), self.publish_diagnostics)
+
+        # scans are processed on a worker thread; the callback only hands over the latest scan
+        self.scan_queue = LatestOnlyQueue()
+        self.filter_lock = threading.Lock()
+
+        # odometry poses are buffered as they arrive, so the filter looks up the odometry at the time of a
+        # scan without waiting on tf.  Scans more than ~odom_tolerance seconds outside of the buffer are skipped
+        self.odom_buffer = OdomBuffer(tolerance=rospy.get_param("~odom_tolerance", 0.05))
+        self.odom_xy_theta = None
+        self.static_transforms = {}
+        rospy.Subscriber(rospy.get_param("~odom_topic", "odom"), Odometry, self.odom_received, queue_size=50)
+
         # laser_subscriber listens for data from the lidar
-        rospy.Subscriber(self.scan_topic, LaserScan, self.scan_received)
-        
-        self.particle_cloud = []
+        rospy.Subscriber(self.scan_topic, LaserScan, self.scan_received, queue_size=1)
 
         # change use_projected_stable_scan to True to use point clouds instead of laser scans
         self.use_projected_stable_scan = True
@@ -130,201 +228,256 @@ class ParticleFilter:
             # subscriber to the odom point cloud
             rospy.Subscriber("projected_stable_scan", PointCloud, self.projected_scan_received)
 
-        self.current_odom_xy_theta = []
-        self.occupancy_field = OccupancyField()
-        self.transform_helper = TFHelper()
-        self.avgPose = np.array([0,0,0]).astype(float)
+        self.transform_publish_rate = rospy.get_param("~transform_publish_rate", 5.0)
+        self.filter_worker = threading.Thread(target=self.run_filter_worker, name="filter_worker")
+        self.filter_worker.daemon = True
+        self.filter_worker.start()
         self.initialized = True
-        self.startedMoving = False
         print("Init")
 
 
     def scan_received(self, msg):
-        """ This is the default logic for what to do when processing scan data.
-            Feel free to modify this, however, we hope it will provide a good
-            guide.  The input msg is an object of type sensor_msgs/LaserScan """
+        """ Hands the scan (a sensor_msgs/LaserScan) to the filter worker thread.
+            If the worker is still busy with an earlier scan that scan is replaced,
+            so the filter always works on the latest data """
 
         if not(self.initialized):
             # wait for initialization to complete
             return
-
-        self.tf_listener.waitForTransform(self.base_frame, self.odom_frame, msg.header.stamp, rospy.Duration(2))
-
-        if not(self.tf_listener.canTransform(self.base_frame, msg.header.frame_id, msg.header.stamp)):
-            # need to know how to transform the laser to the base frame
-            # this will be given by either Gazebo or neato_node
-            print("If 2")
-            return
-
-        # print("list of frames: ", self.tf_listener.getFrameStrings())
-        if not(self.tf_listener.canTransform(self.base_frame, self.odom_frame, msg.header.stamp)):
-            # print("odom: ", self.tf_listener.frameExists(self.odom_frame), "base: ", self.tf_listener.frameExists(self.base_frame))
-            # 
-            # need to know how to transform between base and odometric frames
-            # this will eventually be published by either Gazebo or neato_node
-            print("if 3")
-            return
-
-        # calculate pose of laser relative to the robot base
-        p = PoseStamped(header=Header(stamp=rospy.Time(0),
-                                      frame_id=msg.header.frame_id))
-
-        self.laser_pose = self.tf_listener.transformPose(self.base_frame, p)
-
-        # find out where the robot thinks it is based on its odometry
-        p = PoseStamped(header=Header(stamp=msg.header.stamp, frame_id=self.base_frame) ,pose=Pose())
-        
-        self.odom_pose = self.tf_listener.transformPose(self.odom_frame, p)
-        # store the the odometry pose in a more convenient format (x,y,theta)
-        new_odom_xy_theta = self.transform_helper.convert_pose_to_xy_and_theta(self.odom_pose.pose)
-
-        delta = self.update_particles_with_odom(msg)
-        dx = delta[0] #+ np.random.normal(delta[0], scale=1)
-        dy = delta[1] #+  np.random.normal(delta[1], scale=1)
-        da = delta[2] #+  np.random.normal(delta[2], scale=0.8)  # update based on odometry, returns the delta to move the particles
-        dist = (dx**2 + dy**2)**0.5
-     
-        if math.fabs(dx) >= self.d_thresh or math.fabs(dy) >= self.d_thresh or math.fabs(da) >= self.a_thresh:
-            print('Updating')
-            if not(self.startedMoving):
-                self.startedMoving = True
-            
-            for i in range(len(self.particle_cloud)):
-                self.particle_cloud[i].x += dist*np.cos(self.particle_cloud[i].theta) + np.random.normal(0, 0.01)
-                self.particle_cloud[i].y += dist*np.sin(self.particle_cloud[i].theta) + np.random.normal(0, 0.01)
-                self.particle_cloud[i].theta += da + np.random.normal(0, 0.01)
-          
+        self.scan_queue.put(msg)
+
+    def run_filter_worker(self):
+        """ The body of the filter worker thread: processes the latest scan until shutdown """
+        while not(rospy.is_shutdown()):
+            msg = self.scan_queue.get(timeout=0.1)
+            if msg is None:
+                continue
+            try:
+                with self.filter_lock, self.instrumentation.stage("update"):
+                    self.process_scan(msg)
+            except Exception:
+                # a bad scan must not stop the worker (rospy would have caught this in a callback)
+                self.instrumentation.count("scan_errors")
+                rospy.logerr_throttle(5.0, "failed to process a scan:\n%s" % traceback.format_exc())
+
+    def record_latency(self, stamp):
+        """ Publishes the time from the stamp of a scan to the moment its pose
+            estimate reached the map to odom transform, and warns if it went over
+            the latency budget """
+        latency = (rospy.Time.now() - stamp).to_sec()
+        self.latency_pub.publish(Float32(data=latency))
+        if latency > self.latency_budget:
+            rospy.logwarn_throttle(5.0, "filter update took %.3fs, over the %.3fs budget (%d of %d scans dropped)"
+                                   % (latency, self.latency_budget, self.scan_queue.dropped, self.scan_queue.received))
+
+    def publish_diagnostics(self, event=None):
+        """ Publishes the rolling p50/p95/p99 timings of the filter stages and the
+            counts of dropped and skipped scans as a diagnostic_msgs/DiagnosticArray """
+        summary = self.instrumentation.summary()
+        values = [KeyValue(key="scans received", value=str(self.scan_queue.received)),
+                  KeyValue(key="scans dropped", value=str(self.scan_queue.dropped))]
+        for name, count in sorted(summary["counters"].items()):
+            values.append(KeyValue(key=name.replace("_", " "), value=str(count)))
+        for name, stage in sorted(summary["stages"].items()):
+            for statistic in ("p50_ms", "p95_ms", "p99_ms"):
+                values.append(KeyValue(key="%s %s" % (name, statistic), value="%.3f" % stage[statistic]))
+
+        update = summary["stages"].get("update")
+        if update is not None and update["p95_ms"] > 1000*self.latency_budget:
+            level, message = DiagnosticStatus.WARN, "p95 update time over the latency budget"
         else:
-            print('not updating')
-        if not self.current_odom_xy_theta:
-            self.current_odom_xy_theta = new_odom_xy_theta
-            return
-            
+            level, message = DiagnosticStatus.OK, "ok"
+        status = DiagnosticStatus(level=level, name="robot_localizer: particle filter",
+                                  message=message, hardware_id=rospy.get_name(), values=values)
+        self.diagnostics_pub.publish(DiagnosticArray(header=Header(stamp=rospy.Time.now()), status=[status]))
+
+    def process_scan(self, msg):
+        """ This is the default logic for what to do when processing scan data.
+            Feel free to modify this, however, we hope it will provide a good
+            guide.  The input msg is an object of type sensor_msgs/LaserScan """
 
-        if not(list(self.particle_cloud)):
+        instrumentation = self.instrumentation
+        with instrumentation.stage("odom_delta"):
+            # find out where the robot thinks it is based on its odometry
+            new_odom_xy_theta = self.odom_buffer.at(msg.header.stamp.to_sec())
+            if new_odom_xy_theta is None:
+                # no odometry around the time of the scan (yet); this will eventually be published
+                # by either Gazebo or neato_node
+                instrumentation.count("scans_skipped_no_odom")
+                return
+            self.odom_xy_theta = new_odom_xy_theta
+
+        # move every particle by a noisy sample of the odometry motion
+        moved = self.core.update_odometry(new_odom_xy_theta)
+
+        if not(len(self.core.particle_cloud)) and self.initial_localization != "global":
             # now that we have all of the necessary transforms we can update the particle cloud
-            print("no cloud")
             self.initialize_particle_cloud(msg.header.stamp)
 
+        if self.use_projected_stable_scan and self.last_projected_stable_scan is None:
+            # nothing to weight the particles against yet
+            instrumentation.count("scans_skipped_no_projected_scan")
+            return
+        with instrumentation.stage("scan_conversion"):
+            if self.use_projected_stable_scan:
+                # move the latest projected scan into the base frame as of this scan in one vectorized transform
+                scan_frame, scan_points = self.last_projected_stable_scan
+            else:
+                scan_frame, scan_points = msg.header.frame_id, self.laser_scan_points(msg)
+            if scan_frame == self.odom_frame:
+                to_base = SE2.from_xy_theta(new_odom_xy_theta).inverse()
+            else:
+                to_base = self.static_transform(scan_frame)
+            if to_base is None:
+                # need to know how to transform the laser to the base frame
+                # this will be given by either Gazebo or neato_node
+                instrumentation.count("scans_skipped_no_laser_tf")
+                return
+            self.scan_in_base_link = to_base.apply(scan_points)
+            if isinstance(self.sensor_model, BeamModel):
+                # the beam model casts its rays from the laser itself
+                laser_to_base = self.static_transform(msg.header.frame_id)
+                if laser_to_base is None:
+                    instrumentation.count("scans_skipped_no_laser_tf")
+                    return
+                self.sensor_model.laser_pose = laser_to_base.xy_theta()
+
+        if self.global_localization_pending or not(len(self.core.particle_cloud)):
+            # search the whole map for the poses that explain this scan
+            self.core.initialize_global(self.occupancy_field, self.scan_in_base_link)
+            self.global_localization_pending = False
+            # the new particles already fit this scan
+            moved = False
+
+        self.core.update_scan(self.scan_in_base_link, moved)
+        with instrumentation.stage("map_to_odom"):
+            self.update_robot_pose(msg.header.stamp)
+            self.transform_helper.send_last_map_to_odom_transform()
+        self.record_latency(msg.header.stamp)
+
+        if self.core.started_moving:
+            # only resample once the weights have degenerated
+            if self.core.needs_resample():
+                self.resample_particles()
+            with instrumentation.stage("publish"):
+                self.publish_particles(msg)
+        self.ess_pub.publish(Float32(data=self.core.ess))
         
-        # weight each particle
-        # use the normal scan
-        # lidar_scan = np.array(msg.ranges)
-        self.update_robot_pose(msg.header.stamp) 
-
-        if self.last_projected_stable_scan:
-            last_projected_scan_timeshift = deepcopy(self.last_projected_stable_scan)
-            last_projected_scan_timeshift.header.stamp = msg.header.stamp
-            self.scan_in_base_link = self.tf_listener.transformPointCloud("base_link", last_projected_scan_timeshift)
-            scan = self.scan_in_base_link.points # geometry_msgs.msg._Point.Point
-            
-        myMarkerArray = MarkerArray()    
-        weights = []
-        avgPose = np.array([0,0,0]).astype(float)
-        for i in range(len(self.particle_cloud)):
-            # particles are in odom frame. Current scan is in base_link frame. 
-            # Need to transform scan to odom frame, then transform them to each particle
-            particle_pose = (self.particle_cloud[i].x, self.particle_cloud[i].y, self.particle_cloud[i].theta)
-            # avgPose += np.array([particle_pose]).reshape((3))
-            # for each point in the scan, visualize each one and calculate point's distance to the map
-            distances = 0
-            for j in range(0, len(scan), 10):
-                
-                transformedScan = self.transform_scan([scan[j].x, scan[j].y], particle_pose)
-                # calculate weight for each particle
-                distances += self.occupancy_field.get_closest_obstacle_distance(transformedScan[0], transformedScan[1])
-                
-                #marker = helper.create_marker(self.map_frame, f"translated_scan_{i},{j}", transformedScan[0], transformedScan[1])
-                #myMarkerArray.markers.append(marker)
-            weights.append(distances/len(scan))
-            #self.visualize_particle_scan(myMarkerArray)
-        
-            
-        weights = np.nan_to_num(weights, nan = 1) 
-        weights = 1-weights
-        sumWeights = np.sum(weights)
-        self.weightsNorm = np.array(weights)/sumWeights
-        
-        for i in range(len(self.particle_cloud)):
-            particle_pose = (self.particle_cloud[i].x, self.particle_cloud[i].y, self.particle_cloud[i].theta)
-            avgPose += self.weightsNorm[i]*np.array([particle_pose]).reshape((3))
-            
-        self.avgPose = avgPose
-
-        print("Resampling")
-        if self.startedMoving:
-            self.resample_particles()
-            self.publish_particles(msg)
-        
-    def update_robot_pose(self, timestamp):
+    def update_robot_pose(self, timestamp, odom_xy_theta=None):
         """ Update the estimate of the robot's pose given the updated particles.
             There are two logical methods for this:
                 (1): compute the mean pose
                 (2): compute the most likely pose (i.e. the mode of the distribution)
+            odom_xy_theta is the odometry pose at timestamp, by default the one looked up
+            for the latest scan
         """
         # first make sure that the particle weights are normalized
         # self.normalize_particles()
-        avgQuatern = quaternion_from_euler(0,0,self.avgPose[2])
+        avgPose = self.core.estimate
+        avgQuatern = quaternion_from_euler(0,0,avgPose[2])
         
 
-        self.robot_pose = Pose(position=Point(x=self.avgPose[0],
-                                   y=self.avgPose[1],
+        self.robot_pose = Pose(position=Point(x=avgPose[0],
+                                   y=avgPose[1],
                                    z=0),
                     orientation= Quaternion(x=avgQuatern[0], y=avgQuatern[1], z=avgQuatern[2], w=avgQuatern[3]))
 
-        self.transform_helper.fix_map_to_odom_transform(self.robot_pose, timestamp)
+        self.publish_estimate(timestamp)
+        if odom_xy_theta is None:
+            odom_xy_theta = self.odom_xy_theta
+        if odom_xy_theta is not None:
+            self.transform_helper.fix_map_to_odom_transform(avgPose, odom_xy_theta)
+
+    def publish_estimate(self, timestamp):
+        """ Publish robot_pose with the covariance of the particles about it """
+        covariance = np.zeros((6, 6))
+        # (x, y, theta) are the (x, y, rotation about z) entries of the 6 x 6 matrix
+        covariance[np.ix_([0, 1, 5], [0, 1, 5])] = self.core.covariance
+        self.pose_pub.publish(PoseWithCovarianceStamped(header=Header(stamp=timestamp, frame_id=self.map_frame),
+                                                        pose=PoseWithCovariance(pose=self.robot_pose,
+                                                                                covariance=covariance.ravel().tolist())))
+
+    def request_global_localization(self, request):
+        """ Handles the global_localization service (std_srvs/Empty): the particles are
+            spread over the poses anywhere in the map that best explain the next scan """
+        self.global_localization_pending = True
+        return EmptyResponse()
+
+    def map_update_received(self, msg):
+        """ Patches an edited region of the map (a map_msgs/OccupancyGridUpdate) into the
+            occupancy field.  Only the distance field around the region is recomputed, and the
+            new field is swapped in without stopping the filter """
+        if isinstance(self.sensor_model, BeamModel):
+            rospy.logwarn_once("the beam model's range table is not updated by map updates")
+        patch = np.asarray(msg.data, dtype=np.int8).reshape((msg.height, msg.width))
+        with self.instrumentation.stage("map_update"):
+            self.occupancy_field.update_region(msg.y, msg.x, patch, max_distance=self.core.laser_max_distance)
+
+    def odom_received(self, msg):
+        """ Adds the odometry pose (a nav_msgs/Odometry) to the odometry buffer """
+        self.odom_buffer.add(msg.header.stamp.to_sec(), self.transform_helper.convert_pose_to_xy_and_theta(msg.pose.pose))
+
+    def static_transform(self, frame):
+        """ Returns the SE2 transform from frame to the base frame, or None if tf does not know
+            it yet.  The sensor frames are fixed to the robot, so each one is looked up only once """
+        to_base = self.static_transforms.get(frame)
+        if to_base is None:
+            try:
+                translation, rotation = self.tf_listener.lookupTransform(self.base_frame, frame, rospy.Time(0))
+            except tf.Exception:
+                return None
+            to_base = self.static_transforms[frame] = \
+                self.transform_helper.convert_translation_rotation_to_se2(translation, rotation)
+        return to_base
+
+    def laser_scan_points(self, msg):
+        """ Returns the valid returns of a sensor_msgs/LaserScan as an N x 2 array of (x, y)
+            coordinates in the laser frame """
+        ranges = np.asarray(msg.ranges)
+        angles = msg.angle_min + np.arange(len(ranges))*msg.angle_increment
+        valid = np.isfinite(ranges) & (ranges > msg.range_min) & (ranges < msg.range_max)
+        points = np.empty((np.count_nonzero(valid), 2))
+        points[:, 0] = ranges[valid]*np.cos(angles[valid])
+        points[:, 1] = ranges[valid]*np.sin(angles[valid])
+        return points
 
     def projected_scan_received(self, msg):
-        self.last_projected_stable_scan = msg
-
-    def update_particles_with_odom(self, msg):
-        """ Update the particles using the newly given odometry pose.
-            The function computes the value delta which is a tuple (x,y,theta)
-            that indicates the change in position and angle between the odometry
-            when the particles were last updated and the current odometry.
-
-            msg: this is not really needed to implement this, but is here just in case.
-        """
-        new_odom_xy_theta = self.transform_helper.convert_pose_to_xy_and_theta(self.odom_pose.pose)
-        # compute the change in x,y,theta since our last update
-        delta = (0,0,0)
-        if self.current_odom_xy_theta:
-            old_odom_xy_theta = self.current_odom_xy_theta
-            delta = (new_odom_xy_theta[0] - self.current_odom_xy_theta[0],
-                     new_odom_xy_theta[1] - self.current_odom_xy_theta[1],
-                     new_odom_xy_theta[2] - self.current_odom_xy_theta[2])
-
-            self.current_odom_xy_theta = new_odom_xy_theta
-        else:
-            self.current_odom_xy_theta = new_odom_xy_theta
-        
-        return delta
-
+        """ Stores the points of the projected stable scan (a sensor_msgs/PointCloud) as an
+            N x 2 array of (x, y) coordinates along with the frame they are in """
+        points = np.empty((len(msg.points), 2))
+        points[:, 0] = [point.x for point in msg.points]
+        points[:, 1] = [point.y for point in msg.points]
+        self.last_projected_stable_scan = (msg.header.frame_id, points)
 
     def resample_particles(self):
         """ Resample the particles according to the new particle weights.
             The weights stored with each particle should define the probability that a particular
-            particle is selected in the resampling step.  You may want to make use of the given helper
-            function draw_random_sample.
+            particle is selected in the resampling step.  The scheme is chosen by
+            the core's resample_method (see resampling.RESAMPLERS).
         """
-        try:
-            particles = np.random.choice(a=self.particle_cloud, size=(self.n_particles, 1, 1), p=self.weightsNorm)
-            reshapedParticle = np.array(particles).reshape((len(particles)))
-            copiedParticles = []
-            for i in reshapedParticle:
-                copiedParticles.append(deepcopy(i))
-            self.particle_cloud = copiedParticles
-        except ValueError:
-            pass
-            
+        if self.core.resample():
+            rospy.logwarn("particle weights were degenerate (NaN, negative or all zero); repaired before resampling")
+
     def update_initial_pose(self, msg):
         """ Callback function to handle re-initializing the particle filter based on a pose estimate.
             These pose estimates could be generated by another ROS Node or could come from the rviz GUI """
+        if not(self.initialized):
+            # the odometry buffer and the filter lock do not exist yet
+            return
 
         xy_theta = self.transform_helper.convert_pose_to_xy_and_theta(msg.pose.pose) # convert the pose of the inital guess arrow to xy_theta
-        myCloud = pp.placeParticles() # create placeParticles object
-        self.particle_cloud = myCloud.createRandomXYs(*xy_theta, self.n_particles) # create the n particles centered around xy_theta
-        self.publish_particles("publishing")
+        # the odometry pose at the time of the initial pose, or the newest one we have
+        odom_xy_theta = self.odom_buffer.at(msg.header.stamp.to_sec())
+        if odom_xy_theta is None and self.odom_buffer.latest() is not None:
+            odom_xy_theta = self.odom_buffer.latest()[1]
+        with self.filter_lock:
+            self.core.initialize(xy_theta) # create the n particles centered around xy_theta
+            if odom_xy_theta is not None:
+                # the next scan moves the particles by the odometry since the initial pose
+                self.core.odom_xy_theta = tuple(odom_xy_theta)
+            self.update_robot_pose(msg.header.stamp, odom_xy_theta)
+            self.transform_helper.send_last_map_to_odom_transform()
+            self.publish_particles("publishing")
 
 
 
@@ -332,37 +485,47 @@ class ParticleFilter:
         """ Initialize the particle cloud.
             Arguments
             xy_theta: a triple consisting of the mean x, y, and theta (yaw) to initialize the
-                      particle cloud around.  If this input is omitted, the odometry will be used """
-        if xy_theta is None:
-            xy_theta = self.transform_helper.convert_pose_to_xy_and_theta(self.odom_pose.pose)
-        self.particle_cloud = []
-
-        self.normalize_particles()
+                      particle cloud around.  If this input is omitted, the particles are spread over
+                      the free space of the map when initial_localization is "uniform", and
+                      otherwise the odometry will be used """
+        if xy_theta is None and self.initial_localization == "uniform":
+            self.core.initialize_uniform(self.occupancy_field)
+        else:
+            if xy_theta is None:
+                xy_theta = self.odom_xy_theta
+            self.core.initialize(xy_theta)
         self.update_robot_pose(timestamp)
 
     def publish_particles(self, msg):
-        # print("Published")
-        particles_conv = []
-        for p in self.particle_cloud:
-            particles_conv.append(p.as_pose())
+        """ Publishes the particle cloud (or an evenly decimated subset of at most
+            particle_publish_max particles) as a PoseArray.  Nothing is done when
+            no one is subscribed.  The Pose messages are reused between publishes """
+        if self.particle_pub.get_num_connections() == 0:
+            return
+        x, y, qz, qw = self.core.particle_cloud.planar_pose_arrays(self.particle_publish_max)
+        while len(self.particle_poses) < len(x):
+            self.particle_poses.append(Pose())
+        poses = self.particle_poses[:len(x)]
+        for pose, px, py, pz, pw in zip(poses, x, y, qz, qw):
+            pose.position.x = px
+            pose.position.y = py
+            pose.orientation.z = pz
+            pose.orientation.w = pw
         # actually send the message so that we can view it in rviz
-        
         self.particle_pub.publish(PoseArray(header=Header(stamp=rospy.Time.now(),
                                             frame_id=self.map_frame),
-                                  poses=particles_conv))
+                                  poses=poses))
 
     def transform_scan(self, point, shift):
         """ Takes in an [x,y] point and transforms it by [dx, dy, da] shift
         http://planning.cs.uiuc.edu/node99.html
-        
-        """
-        x = point[0]
-        y = point[1]
-
-        x_prime = x*np.cos(shift[2]) - y*np.sin(shift[2]) + shift[0]
-        y_prime = x*np.sin(shift[2]) + y*np.cos(shift[2]) + shift[1]
 
-        return x_prime, y_prime
+        Both arguments may also be numpy arrays, in which case the transform
+        broadcasts (e.g. points of shape (2, M) against shifts of shape (N, 3)
+        gives N x M transformed coordinates)
+        """
+        transformed = SE2.from_xy_theta(shift).apply(np.stack((point[0], point[1]), axis=-1))
+        return transformed[..., 0], transformed[..., 1]
 
     def visualize_particle_scan(self, markerArray):
         """ Will create marker array
@@ -371,10 +534,10 @@ class ParticleFilter:
 
 if __name__ == '__main__':
     myFilter = ParticleFilter()
-    r = rospy.Rate(5)
-    
+    r = rospy.Rate(myFilter.transform_publish_rate)
+    period = rospy.Duration(1.0/myFilter.transform_publish_rate)
 
     while not(rospy.is_shutdown()):
-        # in the main loop all we do is continuously broadcast the latest map to odom transform
-        myFilter.transform_helper.send_last_map_to_odom_transform()
+        # in the main loop all we do is keep the latest map to odom transform alive between estimates
+        myFilter.transform_helper.send_last_map_to_odom_transform(max_age=period)
         r.sleep()
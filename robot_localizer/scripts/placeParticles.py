@@ -1,91 +1,112 @@
 #!/usr/bin/env python3
 
-import pf_scaffold as pf
-import rospy
-
-from std_msgs.msg import Header, String
-from sensor_msgs.msg import LaserScan, PointCloud
-from geometry_msgs.msg import PoseStamped, PoseWithCovarianceStamped, PoseArray, Pose, Point, Quaternion
-from nav_msgs.srv import GetMap
-from copy import deepcopy
-
-import tf
-from tf import TransformListener
-from tf import TransformBroadcaster
-from tf.transformations import euler_from_quaternion, rotation_matrix, quaternion_from_matrix
-from random import gauss
-
-import math
-import time
-
 import numpy as np
-from numpy.random import random_sample
-from sklearn.neighbors import NearestNeighbors
-from occupancy_field import OccupancyField
-from helper_functions import TFHelper
-from visualization_msgs.msg import Marker
+
+from particle_cloud import ParticleCloud, X, Y, THETA, W
 
 
 class placeParticles():
     """
-    This node creates random particles and visualizes them in rviz
+    Places particle clouds, either normally distributed around a pose or
+    uniformly over the free space of a map.  All of the poses are sampled in
+    a few vectorized calls straight into the arrays of a ParticleCloud.
     """
-    
 
-    def __init__(self):
-        #markerPub = rospy.Publisher('robotMarker', Marker, queue_size=10)
-        # list of all particles
-        self.particles = []
-        # number of particles
+
+    def __init__(self, rng=None, xy_std=0.4, theta_std=0.5):
+        self.rng = rng if rng is not None else np.random.default_rng()
+        # spread of the clouds placed around a pose
+        self.xy_std = xy_std
+        self.theta_std = theta_std
         self.xCenter = 0
         self.yCenter = 0
         self.orientationCenter = 0
-        
+        # free cell index of the last map sampled from
+        self.free_grid = None
+        self.free_x = None
+        self.free_y = None
 
-    def createRandomXYs(self, x, y, theta, n_particles):
+    def _cloud(self, n_particles, cloud):
+        """ Returns cloud if it holds n_particles particles, otherwise a new cloud """
+        if cloud is None or len(cloud) != n_particles:
+            cloud = ParticleCloud(n_particles)
+        return cloud
+
+    def createRandomXYs(self, x, y, theta, n_particles, cloud=None):
         """
-        Create a list of poses with xy's centered around a point
+        Create a cloud of n_particles poses normally distributed around
+        (x, y, theta).  If cloud (a ParticleCloud) already holds n_particles
+        particles its arrays are overwritten instead of allocating new ones.
+        Returns the cloud
         """
         self.xCenter = x
         self.yCenter = y
         self.orientationCenter = theta
-        self.n = n_particles
-        self.xCoords = np.random.normal(self.xCenter, size = self.n, scale=0.4)
-        self.yCoords = np.random.normal(self.yCenter, size = self.n, scale=0.4)
-        
-        for i in range(self.n):
-            particle = pf.Particle(x=self.xCoords[i], y=self.yCoords[i],theta = np.random.normal(theta, scale=0.5))
-            self.particles.append(particle)
-        # for i in range(self.n):
-        #     particle = pf.Particle(x=x, y=y,theta = theta)
-        #     self.particles.append(particle)
-        # print(self.particles)
-        return self.particles
-
-
-    def visualizePoints(self):
-        '''
-        marker = Marker()
-        marker.header.frame_id = "map"
-        marker.color=ColorRGB(0, 0, 1)
-        marker.scale = [0.5,0.5,0.5]
-        for i in range(self.n):
-            marker.pose.position.x = self.xCoords[i]
-            marker.pose.position.y = self.yCoords[i]
-        '''
-            
-            
-
-        
+        cloud = self._cloud(n_particles, cloud)
+        state = cloud.state
+        # one call fills every column with noise; the weights are reset below
+        self.rng.standard_normal(out=state)
+        state *= (self.xy_std, self.xy_std, self.theta_std, 0.0)
+        state[:, X] += x
+        state[:, Y] += y
+        _wrap_angles(state[:, THETA], theta)
+        state[:, W] = 1.0/max(n_particles, 1)
+        return cloud
+
+    def createUniformXYs(self, field, n_particles, cloud=None):
+        """
+        Create a cloud of n_particles poses spread uniformly over the free
+        cells of the map of field (an OccupancyField) with uniformly random
+        headings, so that no particle starts inside a wall or outside of the
+        map.  cloud is reused as in createRandomXYs.  Returns the cloud
+        """
+        free_x, free_y = self.free_cells(field)
+        if len(free_x) == 0:
+            raise ValueError("the map has no free cells to place particles in")
+        cloud = self._cloud(n_particles, cloud)
+        state = cloud.state
+        self.rng.random(out=state)
+        # the weight column picks the cell, the x and y columns the position in it
+        cells = (state[:, W]*len(free_x)).astype(np.intp)
+        state[:, X] *= field.resolution
+        state[:, X] += free_x[cells]
+        state[:, Y] *= field.resolution
+        state[:, Y] += free_y[cells]
+        state[:, THETA] *= 2*np.pi
+        state[:, THETA] -= np.pi
+        state[:, W] = 1.0/max(n_particles, 1)
+        return cloud
+
+    def free_cells(self, field):
+        """
+        Returns the map coordinates (x, y) of the bottom left corners of the
+        free cells of the map of field.  The index is computed once per map
+        and recomputed when the map is updated
+        """
+        if self.free_grid is not field.grid:
+            rows, cols = np.nonzero(field.grid == 0)
+            self.free_x = field.origin[0] + cols*field.resolution
+            self.free_y = field.origin[1] + rows*field.resolution
+            self.free_grid = field.grid
+        return self.free_x, self.free_y
+
+
+def _wrap_angles(angles, offset):
+    """ Adds offset to the array angles and maps them to [-pi, pi) in place """
+    angles += offset + np.pi
+    np.remainder(angles, 2*np.pi, out=angles)
+    angles -= np.pi
 
 
 if __name__ == '__main__':
+    import rospy
+    import pf_scaffold as pf
+
     myFilter = pf.ParticleFilter()
     myCloud = placeParticles()
-    myCloud.createRandomXYs()
-    myFilter.particle_cloud = myCloud.particles
+    myFilter.core.particle_cloud = myCloud.createRandomXYs(0, 0, 0, myFilter.core.n_particles)
     myFilter.publish_particles("publish")
-    print(myFilter.particle_cloud[0].x)
+    print(myFilter.core.particle_cloud[0].x)
     r = rospy.Rate(50)
 
     while not(rospy.is_shutdown()):
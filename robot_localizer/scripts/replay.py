@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+""" Runs the particle filter over recorded data without a ROS master, as fast
+    as the CPU allows, and writes the estimated poses to a file.
+
+    usage: replay.py ../maps/ac109_1.yaml run.npz -o poses.txt
+
+    A recording is an npz file holding
+        odom_stamps: a K array of odometry times (seconds, increasing)
+        odom: a K x 3 array of the odometry poses (x, y, theta) at those times
+        scan_stamps: an S array of scan times (seconds, increasing)
+        scan_offsets: an S + 1 array; the points of scan i are the rows
+                      scan_offsets[i]:scan_offsets[i + 1] of scan_points
+        scan_points: a P x 2 array of the (x, y) scan points in the robot's
+                     base frame
+        initial_pose: (optional) the (x, y, theta) pose in the map frame to
+                      start the particle cloud around
+    save_recording writes this format; bag_to_recording.py converts bags
+    recorded on the robot to it.  The odometry is linearly interpolated to
+    the time of each scan.
+
+    The output has one line per scan: the scan time and the estimated pose
+    (x, y, theta) in the map frame.  --timing writes the per stage timings
+    (see instrumentation.py) as JSON. """
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from beam_model import BeamModel
+from field_cache import FieldCache, DEFAULT_CACHE_DIR
+from filter_core import FilterCore
+from occupancy_field import OccupancyField
+from scan_preprocessing import ScanPreprocessor
+
+
+class Recording(object):
+    """ Scans and odometry recorded from a robot
+        Attributes:
+            odom_stamps, odom, scan_stamps, scan_offsets, scan_points,
+            initial_pose: as in the npz format described above (initial_pose
+            is None if it was not recorded)
+    """
+
+    def __init__(self, odom_stamps, odom, scan_stamps, scan_offsets,
+                 scan_points, initial_pose=None):
+        self.odom_stamps = np.asarray(odom_stamps, dtype=np.float64)
+        self.odom = np.asarray(odom, dtype=np.float64).reshape((-1, 3))
+        self.scan_stamps = np.asarray(scan_stamps, dtype=np.float64)
+        self.scan_offsets = np.asarray(scan_offsets, dtype=np.intp)
+        self.scan_points = np.asarray(scan_points,
+                                      dtype=np.float64).reshape((-1, 2))
+        self.initial_pose = None if initial_pose is None \
+            else np.asarray(initial_pose, dtype=np.float64)
+        if len(self.odom_stamps) != len(self.odom) or len(self.odom) == 0:
+            raise ValueError("odom_stamps and odom must be non-empty and "
+                             "of the same length")
+        if len(self.scan_offsets) != len(self.scan_stamps) + 1:
+            raise ValueError("scan_offsets must have one more entry than "
+                             "scan_stamps")
+
+    @classmethod
+    def from_scans(cls, odom_stamps, odom, scan_stamps, scans,
+                   initial_pose=None):
+        """ Builds a recording from a list of M x 2 scan point arrays """
+        scans = [np.asarray(scan, dtype=np.float64).reshape((-1, 2))
+                 for scan in scans]
+        offsets = np.concatenate(([0], np.cumsum([len(scan)
+                                                  for scan in scans])))
+        points = np.concatenate(scans) if scans else np.zeros((0, 2))
+        return cls(odom_stamps, odom, scan_stamps, offsets, points,
+                   initial_pose)
+
+    def __len__(self):
+        return len(self.scan_stamps)
+
+    def scan(self, i):
+        """ The M x 2 array of the points of scan i """
+        return self.scan_points[self.scan_offsets[i]:self.scan_offsets[i + 1]]
+
+    def odom_at(self, stamps):
+        """ Interpolates the odometry poses at an array of times (clamped to
+            the recorded times) """
+        theta = np.unwrap(self.odom[:, 2])
+        return np.stack([np.interp(stamps, self.odom_stamps, self.odom[:, 0]),
+                         np.interp(stamps, self.odom_stamps, self.odom[:, 1]),
+                         np.interp(stamps, self.odom_stamps, theta)], axis=-1)
+
+
+def load_recording(path):
+    """ Reads a recording from an npz file """
+    with np.load(path) as data:
+        return Recording(data["odom_stamps"], data["odom"],
+                         data["scan_stamps"], data["scan_offsets"],
+                         data["scan_points"],
+                         data["initial_pose"] if "initial_pose" in data
+                         else None)
+
+
+def save_recording(path, recording):
+    """ Writes a recording to an npz file """
+    arrays = dict(odom_stamps=recording.odom_stamps, odom=recording.odom,
+                  scan_stamps=recording.scan_stamps,
+                  scan_offsets=recording.scan_offsets,
+                  scan_points=recording.scan_points)
+    if recording.initial_pose is not None:
+        arrays["initial_pose"] = recording.initial_pose
+    np.savez_compressed(path, **arrays)
+
+
+def replay(core, recording, initial_pose=None, global_field=None):
+    """ Runs core (a FilterCore) over every scan of recording.  The cloud is
+        initialized around initial_pose, the recording's initial pose or,
+        failing both, the first odometry pose.  If global_field (the
+        OccupancyField of the map) is given the robot is instead localized
+        globally from the first scan.  Returns an S x 3 array of the pose
+        estimates after each scan. """
+    odom = recording.odom_at(recording.scan_stamps)
+    if global_field is not None and len(recording):
+        core.initialize_global(global_field, recording.scan(0))
+    else:
+        if initial_pose is None:
+            initial_pose = recording.initial_pose
+        if initial_pose is None:
+            initial_pose = recording.odom[0]
+        core.initialize(initial_pose)
+
+    estimates = np.empty((len(recording), 3))
+    for i in range(len(recording)):
+        with core.instrumentation.stage("update"):
+            estimates[i] = core.step(odom[i], recording.scan(i))
+    return estimates
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the particle filter over a recording without ROS")
+    parser.add_argument("map", help="map_server style map file (maps/*.yaml)")
+    parser.add_argument("recording", help="npz recording of scans and odometry")
+    parser.add_argument("-o", "--output", default="poses.txt",
+                        help="file to write the pose estimates to")
+    parser.add_argument("--initial-pose", type=float, nargs=3,
+                        metavar=("X", "Y", "THETA"),
+                        help="pose to start the particle cloud around")
+    parser.add_argument("--global", dest="global_localization", action="store_true",
+                        help="localize globally from the first scan instead of starting at a pose")
+    parser.add_argument("--n-particles", type=int, default=400)
+    parser.add_argument("--no-kld", action="store_true",
+                        help="keep the number of particles fixed")
+    parser.add_argument("--sensor-model", default="likelihood_field",
+                        choices=("likelihood_field", "beam"))
+    parser.add_argument("--sigma-hit", type=float, default=0.1)
+    parser.add_argument("--resample-method", default="systematic")
+    parser.add_argument("--pose-estimate", default="mean", choices=("mean", "mode"))
+    parser.add_argument("--scan-downsample", default="angular",
+                        choices=ScanPreprocessor.STRATEGIES)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--field-cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--timing", metavar="FILE", help="file to write the stage timings to (JSON)")
+    args = parser.parse_args(argv)
+
+    cache = FieldCache(args.field_cache_dir)
+    field = OccupancyField.from_yaml(args.map, cache=cache)
+    if args.sensor_model == "beam":
+        sensor_model = BeamModel(field, cache=cache)
+    else:
+        sensor_model = field
+    rng = np.random.default_rng(args.seed)
+    core = FilterCore(sensor_model,
+                      n_particles=args.n_particles,
+                      rng=rng,
+                      scan_preprocessor=ScanPreprocessor(strategy=args.scan_downsample, rng=rng),
+                      sigma_hit=args.sigma_hit,
+                      resample_method=args.resample_method,
+                      pose_estimate=args.pose_estimate,
+                      kld_sampling=not(args.no_kld))
+
+    recording = load_recording(args.recording)
+    start = time.time()
+    estimates = replay(core, recording, args.initial_pose,
+                       global_field=field if args.global_localization else None)
+    elapsed = time.time() - start
+
+    np.savetxt(args.output, np.column_stack((recording.scan_stamps, estimates)),
+               fmt="%.6f", header="stamp x y theta")
+    sys.stderr.write("%d scans in %.3fs (%.1f scans/s), poses written to %s\n"
+                     % (len(recording), elapsed,
+                        len(recording)/max(elapsed, 1e-9), args.output))
+    if args.timing:
+        core.instrumentation.dump(args.timing)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+""" Resampling schemes for the particle filter.  Each scheme takes an array
+    of particle weights and returns the indices of the particles to keep, so
+    the particle state can be gathered with a single fancy-index copy. """
+
+import numpy as np
+
+
+def sanitize_weights(weights):
+    """ Returns a normalized copy of weights along with a flag that is True
+        when the weights were degenerate.  NaN, infinite and negative weights
+        are treated as zero.  If no weight is left positive (or the weights
+        are empty) every particle gets the same weight. """
+    weights = np.array(weights, dtype=np.float64)
+    bad = ~np.isfinite(weights) | (weights < 0)
+    weights[bad] = 0.0
+    total = np.sum(weights)
+    if len(weights) == 0 or total <= 0:
+        return np.full(len(weights), 1.0/max(len(weights), 1)), True
+    return weights/total, bool(bad.any())
+
+
+def _select(weights, positions):
+    """ Returns the index of the particle whose slice of the cumulative
+        weight contains each of the (sorted) positions in [0, 1) """
+    cumulative = np.cumsum(weights)
+    # guard against the cumulative sum falling just short of 1
+    cumulative[-1] = 1.0
+    indices = np.searchsorted(cumulative, positions, side="right")
+    return np.minimum(indices, len(weights) - 1)
+
+
+def systematic_resample(weights, n, rng):
+    """ Low-variance resampling: n evenly spaced positions with a single
+        random offset """
+    positions = (rng.random() + np.arange(n))/n
+    return _select(weights, positions)
+
+
+def stratified_resample(weights, n, rng):
+    """ Draws one position uniformly from each of n equal strata """
+    positions = (rng.random(n) + np.arange(n))/n
+    return _select(weights, positions)
+
+
+def multinomial_resample(weights, n, rng):
+    """ Draws n independent positions (the classic, highest variance scheme) """
+    positions = np.sort(rng.random(n))
+    return _select(weights, positions)
+
+
+def residual_resample(weights, n, rng):
+    """ Keeps floor(n*w) copies of every particle deterministically and draws
+        the remaining particles from the residual weights """
+    counts = np.floor(n*weights).astype(np.intp)
+    indices = np.repeat(np.arange(len(weights)), counts)
+    remaining = n - len(indices)
+    if remaining > 0:
+        residuals = n*weights - counts
+        residuals /= np.sum(residuals)
+        indices = np.concatenate(
+            (indices, multinomial_resample(residuals, remaining, rng)))
+    return indices
+
+
+RESAMPLERS = {
+    "systematic": systematic_resample,
+    "stratified": stratified_resample,
+    "multinomial": multinomial_resample,
+    "residual": residual_resample,
+}
+
+
+def resample(weights, n, rng, method="systematic"):
+    """ Returns n particle indices drawn according to weights with the given
+        method (one of RESAMPLERS), along with a flag that is True when the
+        weights were degenerate and had to be repaired first (see
+        sanitize_weights) """
+    if method not in RESAMPLERS:
+        raise ValueError("unknown resampling method %r (expected one of %s)"
+                         % (method, ", ".join(sorted(RESAMPLERS))))
+    weights, degenerate = sanitize_weights(weights)
+    if len(weights) == 0:
+        return np.zeros(0, dtype=np.intp), degenerate
+    return RESAMPLERS[method](weights, n, rng), degenerate
+
+
+def kld_sample_size(k, epsilon=0.05, z=2.326):
+    """ Returns the number of particles needed so that, with probability
+        given by the standard normal quantile z, the KL divergence between
+        the sample-based and the true posterior is below epsilon when the
+        samples occupy k histogram bins (Fox, "Adapting the Sample Size in
+        Particle Filters Through KLD-Sampling", 2003).  k may be an array. """
+    k = np.asarray(k, dtype=np.float64)
+    k1 = np.maximum(k - 1, 1)
+    a = 2.0/(9.0*k1)
+    required = k1/(2.0*epsilon)*(1.0 - a + np.sqrt(a)*z)**3
+    return np.where(k > 1, np.ceil(required), 1)
+
+
+def _bin_keys(poses, bin_size):
+    """ Packs the (x, y, theta) histogram bin of each pose into one int64 """
+    theta = np.arctan2(np.sin(poses[:, 2]), np.cos(poses[:, 2]))
+    bins = np.floor(np.column_stack((poses[:, 0]/bin_size[0],
+                                     poses[:, 1]/bin_size[1],
+                                     theta/bin_size[2]))).astype(np.int64)
+    # 21 bits per axis covers over two hundred kilometers of 0.25 m bins
+    bins += 1 << 20
+    return (bins[:, 0] << 42) | (bins[:, 1] << 21) | bins[:, 2]
+
+
+def _new_bins(keys, seen):
+    """ Returns a mask of the keys that are the first occurrence of a bin
+        that is not in seen (a sorted array of keys), and the sorted union of
+        seen and keys """
+    unique, first = np.unique(keys, return_index=True)
+    is_new = np.zeros(len(keys), dtype=bool)
+    is_new[first[~np.isin(unique, seen, assume_unique=True)]] = True
+    return is_new, np.union1d(seen, unique)
+
+
+def _enough(k, n, epsilon, z, min_n):
+    """ Mask of the sample counts n (with k occupied bins) that meet the KLD
+        bound and min_n """
+    return (n >= kld_sample_size(k, epsilon, z)) & (n >= min_n)
+
+
+def kld_resample(weights, poses, rng, min_n, max_n,
+                 bin_size=(0.25, 0.25, np.pi/18), epsilon=0.05, z=2.326,
+                 method="systematic"):
+    """ KLD-adaptive resampling.  Draws candidate indices with the given
+        method in shuffled blocks of doubling size (starting at min_n) and
+        keeps the shortest prefix that is at least min_n long and at least
+        as long as the KLD bound for the number of (x, y, theta) bins it
+        occupies (see kld_sample_size and _enough), so the size of the new
+        cloud tracks how spread out the particles are.  Like Fox's algorithm
+        this stops drawing once the bound is met, so a converged cloud costs
+        about its own size rather than max_n.
+        poses: the N x 3 (x, y, theta) poses of the current particles
+        bin_size: the (x, y, theta) size of the histogram bins
+        Returns the indices and the degenerate flag of resample """
+    if method not in RESAMPLERS:
+        raise ValueError("unknown resampling method %r (expected one of %s)"
+                         % (method, ", ".join(sorted(RESAMPLERS))))
+    weights, degenerate = sanitize_weights(weights)
+    if len(weights) == 0 or max_n <= 0:
+        return np.zeros(0, dtype=np.intp), degenerate
+    poses = np.asarray(poses)
+
+    blocks = []
+    seen = np.zeros(0, dtype=np.int64)
+    k = drawn = 0
+    block = max(1, min(min_n, max_n))
+    while True:
+        indices = RESAMPLERS[method](weights, block, rng)
+        indices = indices[rng.permutation(block)]
+        blocks.append(indices)
+        # the bins occupied by each prefix, carried over from earlier blocks
+        is_new, seen = _new_bins(_bin_keys(poses[indices], bin_size), seen)
+        occupied = k + np.cumsum(is_new)
+        enough = _enough(occupied, drawn + np.arange(1, block + 1),
+                         epsilon, z, min_n)
+        k = occupied[-1]
+        if enough.any():
+            n = drawn + int(np.argmax(enough)) + 1
+            return np.concatenate(blocks)[:n], degenerate
+        drawn += block
+        if drawn >= max_n:
+            return np.concatenate(blocks), degenerate
+        block = min(drawn, max_n - drawn)
@@ -0,0 +1,100 @@
+""" Scan preprocessing.  Runs once per scan before any particle is scored:
+    converts the scan to an M x 2 numpy array, drops invalid returns and
+    downsamples it so that every particle is scored against a compact set of
+    informative points. """
+
+import numpy as np
+
+
+def valid_points(points, min_range, max_range):
+    """ Returns the rows of the M x 2 array points that are finite and whose
+        range lies in [min_range, max_range] """
+    points = np.asarray(points, dtype=np.float64).reshape((-1, 2))
+    ranges = np.hypot(points[:, 0], points[:, 1])
+    keep = np.isfinite(ranges) & (ranges >= min_range) & (ranges <= max_range)
+    return points[keep]
+
+
+def stride_downsample(points, stride):
+    """ Keeps every stride-th point """
+    return points[::max(1, int(stride))]
+
+
+def angular_downsample(points, bin_size):
+    """ Keeps the first point in each angular bin of bin_size radians """
+    bins = np.floor(np.arctan2(points[:, 1], points[:, 0])/bin_size)
+    _, first = np.unique(bins, return_index=True)
+    return points[np.sort(first)]
+
+
+def voxel_downsample(points, voxel_size):
+    """ Replaces the points in each voxel_size x voxel_size cell by their
+        centroid """
+    if len(points) == 0:
+        return points
+    cells = np.floor(points/voxel_size).astype(np.int64)
+    _, inverse, counts = np.unique(cells, axis=0, return_inverse=True,
+                                   return_counts=True)
+    inverse = inverse.reshape(-1)
+    centroids = np.empty((len(counts), 2))
+    centroids[:, 0] = np.bincount(inverse, weights=points[:, 0])/counts
+    centroids[:, 1] = np.bincount(inverse, weights=points[:, 1])/counts
+    return centroids
+
+
+def random_downsample(points, max_points, rng):
+    """ Keeps a random subset of at most max_points points (in scan order) """
+    if len(points) <= max_points:
+        return points
+    keep = np.sort(rng.choice(len(points), size=int(max_points), replace=False))
+    return points[keep]
+
+
+class ScanPreprocessor(object):
+    """ Filters and downsamples scans
+        Attributes:
+            min_range, max_range: returns outside of this range (meters) are
+            dropped as invalid
+            strategy: the downsampling strategy, one of
+                "none": keep every valid point
+                "stride": keep every stride-th point
+                "angular": keep one point per angular_bin radians of bearing
+                "voxel": keep the centroid of the points in each voxel_size
+                         meter grid cell
+                "random": keep a random subset of max_points points
+            stride, angular_bin, voxel_size, max_points: the parameters of the
+            strategies
+            rng: the numpy random Generator used by the random strategy
+    """
+
+    STRATEGIES = ("none", "stride", "angular", "voxel", "random")
+
+    def __init__(self, min_range=0.05, max_range=5.0, strategy="angular",
+                 stride=2, angular_bin=np.radians(2.0), voxel_size=0.1,
+                 max_points=120, rng=None):
+        if strategy not in self.STRATEGIES:
+            raise ValueError("unknown scan downsampling strategy %r "
+                             "(expected one of %s)"
+                             % (strategy, ", ".join(self.STRATEGIES)))
+        self.min_range = min_range
+        self.max_range = max_range
+        self.strategy = strategy
+        self.stride = stride
+        self.angular_bin = angular_bin
+        self.voxel_size = voxel_size
+        self.max_points = max_points
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+    def process(self, points):
+        """ Returns the filtered and downsampled M x 2 array of the (x, y)
+            scan points in points """
+        points = valid_points(points, self.min_range, self.max_range)
+        if self.strategy == "stride":
+            return stride_downsample(points, self.stride)
+        if self.strategy == "angular":
+            return angular_downsample(points, self.angular_bin)
+        if self.strategy == "voxel":
+            return voxel_downsample(points, self.voxel_size)
+        if self.strategy == "random":
+            return random_downsample(points, self.max_points, self.rng)
+        return points
@@ -0,0 +1,88 @@
+""" Rigid transforms of the plane.  The filter only ever needs the planar
+    (x, y, yaw) part of a transform, so composing and inverting them in
+    closed form is much cheaper than going through 4x4 matrices and
+    quaternions with tf.transformations. """
+
+import numpy as np
+
+
+def angle_normalize(z):
+    """ Maps angles (a scalar or an array) to the range [-pi, pi] """
+    return np.arctan2(np.sin(z), np.cos(z))
+
+
+class SE2(object):
+    """ A rotation by theta followed by a translation by (x, y), i.e. the pose
+        of a frame in its parent frame.  x, y and theta may be scalars or
+        arrays of the same shape, so that one SE2 holds many transforms (e.g.
+        the pose of every particle) and operates on all of them at once.
+        Attributes:
+            x, y: the translation
+            theta: the rotation (radians)
+    """
+    __slots__ = ('x', 'y', 'theta')
+
+    def __init__(self, x=0.0, y=0.0, theta=0.0):
+        self.x = x
+        self.y = y
+        self.theta = theta
+
+    @classmethod
+    def from_xy_theta(cls, xy_theta):
+        """ Builds the transform(s) of an (x, y, theta) triple or an N x 3
+            array of them """
+        xy_theta = np.asarray(xy_theta, dtype=np.float64)
+        return cls(xy_theta[..., 0], xy_theta[..., 1], xy_theta[..., 2])
+
+    @classmethod
+    def from_matrix(cls, matrix):
+        """ Builds the transform of a 3x3 homogeneous matrix """
+        return cls(matrix[0, 2], matrix[1, 2],
+                   np.arctan2(matrix[1, 0], matrix[0, 0]))
+
+    def xy_theta(self):
+        """ The transform(s) as an array of (x, y, theta) """
+        return np.stack(np.broadcast_arrays(self.x, self.y, self.theta),
+                        axis=-1).astype(np.float64)
+
+    def matrix(self):
+        """ The 3x3 homogeneous matrix of a single transform """
+        c, s = np.cos(self.theta), np.sin(self.theta)
+        return np.array([[c, -s, self.x],
+                         [s, c, self.y],
+                         [0.0, 0.0, 1.0]])
+
+    def compose(self, other):
+        """ Returns self * other, the transform that applies other and then
+            self (e.g. map -> base_link from map -> odom and
+            odom -> base_link) """
+        c, s = np.cos(self.theta), np.sin(self.theta)
+        return SE2(self.x + c*other.x - s*other.y,
+                   self.y + s*other.x + c*other.y,
+                   angle_normalize(self.theta + other.theta))
+
+    __mul__ = compose
+
+    def inverse(self):
+        """ Returns the transform that undoes self """
+        c, s = np.cos(self.theta), np.sin(self.theta)
+        return SE2(-c*self.x - s*self.y,
+                   s*self.x - c*self.y,
+                   angle_normalize(-self.theta))
+
+    def apply(self, points):
+        """ Transforms points, an array whose last axis holds (x, y).  For an
+            array of transforms the result has the shape of the transforms
+            followed by the shape of points, e.g. N transforms of M x 2 points
+            give N x M x 2 points. """
+        points = np.asarray(points, dtype=np.float64)
+        px, py = points[..., 0], points[..., 1]
+        # line the transforms up ahead of the point axes
+        shape = np.shape(self.theta) + (1,)*px.ndim
+        theta = np.reshape(self.theta, shape)
+        c, s = np.cos(theta), np.sin(theta)
+        x, y = np.reshape(self.x, shape), np.reshape(self.y, shape)
+        return np.stack((c*px - s*py + x, s*px + c*py + y), axis=-1)
+
+    def __repr__(self):
+        return "SE2(x=%r, y=%r, theta=%r)" % (self.x, self.y, self.theta)